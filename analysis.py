@@ -1,13 +1,22 @@
+import functools
 import glob
+import json
+import multiprocessing
 import os
 import os.path
+import time
+import warnings
 
 import numpy as np
 import matplotlib.pyplot as plt
+from matplotlib.colors import LogNorm
 import pandas as pd
 import seaborn as sns
 
 from sklearn.ensemble import ExtraTreesRegressor
+from sklearn.model_selection import KFold
+
+import tablecache
 
 plt.style.use('seaborn')
 
@@ -19,9 +28,33 @@ GENDER_MAP = {
 }
 
 
+DATA_DIR = '/media/data/500px-progressions-processed/'
+
+# all progressions in a single frame, written by load_frame together with
+# the fingerprint of the files it has been built from
+CONSOLIDATED = os.path.join(DATA_DIR, 'consolidated.parquet')
+
+# columns post_process needs in addition to the requested ones
+REQUIRED_COLUMNS = ['meta-uploaded']
+
+# derived tables like the aggregated frame, see cached_table
+CACHE = tablecache.TableCache(os.path.join(DATA_DIR, 'cache'),
+                              max_bytes=4 << 30)
+# increase when the derivation of the respective table changes
+CONSOLIDATE_VERSION = 1
+AGGREGATE_VERSION = 1
+FEATURES_VERSION = 2
+
+
+# msgpack files of older versions of extract.py cannot be read since pandas
+# 1.0 and are ignored, extracting their archives again writes parquet
 def get_files():
-    return glob.glob(os.path.join('/media/data/500px-progressions-processed/',
-                                  '*.msg'))
+    return [f for f in glob.glob(os.path.join(DATA_DIR, '*.parquet'))
+            if os.path.basename(f).split('.')[0].isdigit()]
+
+
+def read_progression(path, columns=None):
+    return pd.read_parquet(path, columns=columns)
 
 
 def post_process(series):
@@ -36,22 +69,310 @@ def post_process(series):
     return series
 
 
-def load_data(files):
+# columns optionally restricts the loaded columns
+def load_data(files, columns=None):
+    if columns is not None:
+        columns = list(columns) + [column for column in REQUIRED_COLUMNS
+                                   if column not in columns]
     return {os.path.splitext(os.path.basename(f))[0]:
-            post_process(pd.read_msgpack(f))
+            post_process(read_progression(f, columns))
             for f in files}
 
 
-def aggregate(data):
+def _read_progression(columns, path):
+    return read_progression(path, columns)
+
+
+# index-rel-upload and index-rel-data of post_process for a consolidated
+# frame, computed per photo at once
+def post_process_frame(frame):
+    time = frame.index.get_level_values('time').to_series(index=frame.index)
+    per_photo = dict(level='photo_id', observed=True, sort=False)
+    frame['index-rel-upload'] = time - frame['meta-uploaded'].groupby(
+        **per_photo).transform('first')
+    frame['index-rel-data'] = time - time.groupby(**per_photo).transform(
+        'min')
+    return frame
+
+
+# Reads the progressions in parallel into one frame indexed by photo_id
+# (categorical) and time. columns optionally restricts the loaded columns.
+# With a single process the files are read without a pool, e.g. in the
+# daemonic worker of another pool.
+def consolidate(files, columns=None, processes=None):
+    if columns is not None:
+        columns = list(columns) + [column for column in REQUIRED_COLUMNS
+                                   if column not in columns]
+    photo_ids = [os.path.splitext(os.path.basename(f))[0] for f in files]
+    read = functools.partial(_read_progression, columns)
+    if processes == 1:
+        frames = [read(f) for f in files]
+    else:
+        with multiprocessing.Pool(processes) as pool:
+            frames = pool.map(read, files, chunksize=16)
+    if not frames:
+        return pd.DataFrame(columns=columns)
+    return post_process_frame(_concat(frames, photo_ids))
+
+
+def _concat(frames, photo_ids):
+    frame = pd.concat(frames, keys=photo_ids, names=['photo_id', 'time'])
+    # categories of the single files are merged
+    for column, dtype in frames[0].dtypes.items():
+        if isinstance(dtype, pd.CategoricalDtype) and \
+                frame[column].dtype == object:
+            frame[column] = frame[column].astype('category')
+    frame.index = frame.index.set_levels(
+        pd.CategoricalIndex(frame.index.levels[0]), level='photo_id')
+    return frame
+
+
+# consolidated frame for data from load_data or load_frame
+def as_frame(data):
+    if isinstance(data, pd.DataFrame):
+        return data
+    return _concat(list(data.values()), list(data.keys()))
+
+
+# key is the fingerprint of the files the frame has been built from
+def save_consolidated(frame, path=CONSOLIDATED, key=None):
+    key_path = path + '.fingerprint'
+    # the store does not match any files while it is replaced
+    try:
+        os.remove(key_path)
+    except FileNotFoundError:
+        pass
+    temp_path = '{}.{}.tmp'.format(path, os.getpid())
+    frame.to_parquet(temp_path, engine='pyarrow', compression='zstd')
+    os.replace(temp_path, path)
+    if key is not None:
+        with open(temp_path, 'w') as f:
+            f.write(key)
+        os.replace(temp_path, key_path)
+
+
+# fingerprint of a store built from files
+def consolidated_key(files):
+    return tablecache.fingerprint(files, CONSOLIDATE_VERSION)
+
+
+# fingerprint of the files the store at path has been built from, None if
+# the store or its fingerprint is missing
+def consolidated_fingerprint(path=CONSOLIDATED):
+    try:
+        with open(path + '.fingerprint') as f:
+            key = f.read().strip()
+    except FileNotFoundError:
+        return None
+    return key if os.path.exists(path) else None
+
+
+def load_consolidated(path=CONSOLIDATED, columns=None):
+    if columns is not None:
+        columns = list(columns) + [column for column in REQUIRED_COLUMNS +
+                                   ['index-rel-upload', 'index-rel-data']
+                                   if column not in columns]
+    return pd.read_parquet(path, columns=columns)
+
+
+# Consolidated frame of the progressions in files (default: get_files()). It
+# is read from the store at path if that has been built from the same files,
+# otherwise it is built and replaces the store for later sessions. rebuild
+# forces building the store.
+def load_frame(files=None, columns=None, path=CONSOLIDATED, processes=None,
+               rebuild=False):
+    files = get_files() if files is None else files
+    key = consolidated_key(files)
+    if rebuild or consolidated_fingerprint(path) != key:
+        frame = consolidate(files, processes=processes)
+        save_consolidated(frame, path, key)
+        if columns is not None:
+            frame = frame[[column for column in frame
+                           if column in columns or
+                           column in REQUIRED_COLUMNS or
+                           column.startswith('index-')]]
+        return frame
+    return load_consolidated(path, columns)
+
+
+# functions of window_aggregate. first and last take the values of the first
+# and last snapshot even if they are missing, the others only apply to
+# numeric and temporal columns.
+WINDOW_FUNCTIONS = ['first', 'last', 'delta', 'min', 'max', 'mean']
+
+
+# One row per photo with a '<function>-<column>' column for every function
+# and column (default: all) over the snapshots of a consolidated frame.
+# start and end optionally restrict the snapshots to a window of the
+# timedelta column relative_to, e.g. start='0h', end='48h'.
+def window_aggregate(frame, columns=None, functions=('first', 'last'),
+                     start=None, end=None, relative_to='index-rel-upload'):
+    if start is not None:
+        frame = frame[frame[relative_to] >= pd.Timedelta(start)]
+    if end is not None:
+        frame = frame[frame[relative_to] <= pd.Timedelta(end)]
+    if columns is not None:
+        frame = frame[list(columns)]
+
+    groups = frame.groupby(level='photo_id', observed=True, sort=False)
+    numeric = frame.select_dtypes(
+        include=['number', 'datetime', 'timedelta']).columns
+    numeric_groups = frame[numeric].groupby(level='photo_id', observed=True,
+                                            sort=False)
+    rows = {}
+    if set(functions) & {'first', 'delta'}:
+        rows['first'] = groups.head(1).droplevel('time')
+    if set(functions) & {'last', 'delta'}:
+        rows['last'] = groups.tail(1).droplevel('time')
+
+    results = []
+    for function in functions:
+        if function in ('first', 'last'):
+            result = rows[function]
+        elif function == 'delta':
+            result = rows['last'][numeric] - rows['first'][numeric]
+        elif function in WINDOW_FUNCTIONS:
+            result = numeric_groups.agg(function)
+        else:
+            raise ValueError('Unknown function {}'.format(function))
+        results.append(result.add_prefix(function + '-'))
+    return pd.concat(results, axis=1)
 
-    entries = {}
-    for photo_id, series in data.items():
-        first = series.iloc[0]
-        first.index = ['first-{}'.format(c) for c in first.index]
-        last = series.iloc[-1]
-        last.index = ['last-{}'.format(c) for c in last.index]
-        entries[photo_id] = pd.concat([first, last])
-    return pd.DataFrame.from_dict(entries, orient='index')
+
+def aggregate(data):
+    return window_aggregate(as_frame(data), functions=('first', 'last'))
+
+
+# table derived from files by compute(), reused from CACHE as long as the
+# files and the version do not change
+def cached_table(name, files, version, compute, *parameters):
+    return CACHE.cached(name, files, version, compute, *parameters)
+
+
+def cached_aggregate(files, processes=None):
+    return cached_table('aggregate', files, AGGREGATE_VERSION,
+                        lambda: aggregate(consolidate(files,
+                                                      processes=processes)))
+
+
+# metrics resampled by default
+PROGRESSION_METRICS = [
+    'json-rating',
+    'json-times_viewed',
+    'json-votes_count',
+    'json-favorites_count',
+    'json-comments_count',
+]
+
+
+# Metrics of all photos on a shared grid of index-rel-upload bins, as dense
+# arrays of photos x bins with NaN for bins without snapshots.
+class ProgressionMatrix(object):
+
+    def __init__(self, photo_ids, start, width, values):
+        self.photo_ids = pd.Index(photo_ids, name='photo_id')
+        self.start = pd.Timedelta(start)
+        self.width = pd.Timedelta(width)
+        self.values = values
+        count = len(next(iter(values.values()))[0]) if values else 0
+        self.bins = pd.timedelta_range(self.start, periods=count,
+                                       freq=self.width, name='bin')
+
+    # opens the arrays saved by resample_progressions in directory
+    @staticmethod
+    def load(directory, mmap_mode='r'):
+        with open(os.path.join(directory, 'matrix.json')) as f:
+            meta = json.load(f)
+        values = {metric: np.load(os.path.join(directory, metric + '.npy'),
+                                  mmap_mode=mmap_mode)
+                  for metric in meta['metrics']}
+        return ProgressionMatrix(meta['photo_ids'],
+                                 pd.Timedelta(seconds=meta['start']),
+                                 pd.Timedelta(seconds=meta['width']), values)
+
+    def frame(self, metric):
+        return pd.DataFrame(self.values[metric], index=self.photo_ids,
+                            columns=self.bins)
+
+    # bins x percentiles over all photos
+    def percentiles(self, metric, percentiles=(10, 50, 90)):
+        with warnings.catch_warnings():
+            # bins without any snapshot
+            warnings.simplefilter('ignore', RuntimeWarning)
+            bands = np.nanpercentile(self.values[metric], percentiles, axis=0)
+        return pd.DataFrame(bands.T, index=self.bins, columns=percentiles)
+
+    # bins x groups mean curves, labels maps photo IDs to their group, e.g.
+    # aggregated['first-meta-category']
+    def group_means(self, metric, labels):
+        labels = pd.Series(labels).reindex(self.photo_ids)
+        return self.frame(metric).groupby(labels.to_numpy(),
+                                          dropna=True).mean().T
+
+    # change per hour between consecutive bins, photos x (bins - 1)
+    def growth_rates(self, metric):
+        return np.diff(self.values[metric], axis=1) / \
+            (self.width / pd.Timedelta(hours=1))
+
+
+# Resamples the metrics of all progressions to bins of width between start
+# and end of index-rel-upload, each bin holding the mean of its snapshots.
+# With a directory the arrays are memory-mapped .npy files in it, which can
+# be opened again with ProgressionMatrix.load.
+def resample_progressions(data, metrics=PROGRESSION_METRICS, width='1h',
+                          start='0h', end='48h', directory=None,
+                          dtype='float64'):
+    frame = as_frame(data)
+    start = pd.Timedelta(start)
+    width = pd.Timedelta(width)
+    count = int(np.ceil((pd.Timedelta(end) - start) / width))
+
+    photo_ids = frame.index.get_level_values('photo_id')
+    if isinstance(photo_ids, pd.CategoricalIndex):
+        # codes are int8 for up to 127 photos, int16 up to 32767
+        rows = photo_ids.codes.astype('int64')
+        photo_ids = photo_ids.categories
+    else:
+        rows, photo_ids = pd.factorize(photo_ids)
+    hour = pd.Timedelta(hours=1)
+    columns = np.floor((_floats(frame['index-rel-upload']) - start / hour) /
+                       (width / hour))
+    in_grid = (columns >= 0) & (columns < count)
+    cells = rows * count + np.where(in_grid, columns, 0).astype('int64')
+    size = len(photo_ids) * count
+
+    if directory is not None:
+        try:
+            os.makedirs(directory)
+        except FileExistsError:
+            pass
+
+    values = {}
+    for metric in metrics:
+        metric_values = _floats(frame[metric])
+        valid = in_grid & np.isfinite(metric_values)
+        sums = np.bincount(cells[valid], weights=metric_values[valid],
+                           minlength=size)
+        counts = np.bincount(cells[valid], minlength=size)
+        if directory is None:
+            matrix = np.empty((len(photo_ids), count), dtype=dtype)
+        else:
+            matrix = np.lib.format.open_memmap(
+                os.path.join(directory, metric + '.npy'), mode='w+',
+                dtype=dtype, shape=(len(photo_ids), count))
+        matrix[:] = np.where(counts > 0, sums / np.maximum(counts, 1),
+                             np.nan).reshape(len(photo_ids), count)
+        values[metric] = matrix
+
+    if directory is not None:
+        for matrix in values.values():
+            matrix.flush()
+        with open(os.path.join(directory, 'matrix.json'), 'w') as f:
+            json.dump({'metrics': list(metrics),
+                       'photo_ids': [str(photo_id) for photo_id in photo_ids],
+                       'start': start.total_seconds(),
+                       'width': width.total_seconds()}, f)
+    return ProgressionMatrix(photo_ids, start, width, values)
 
 
 def rotate_tick_labels(ax):
@@ -85,7 +406,8 @@ def categorial_distribution(aggregated, item='first-json-user-sex',
     fig = plt.figure()
     series = aggregated[item]
     if replace_map:
-        series = series.replace(GENDER_MAP)
+        # nullable integer columns cannot hold the replacing labels
+        series = series.astype(object).replace(replace_map)
     series.value_counts().sort_index().plot.bar(ax=fig.gca())
 
     apply_standard_args(fig.gca(), **kwargs)
@@ -131,43 +453,93 @@ def numerical_distribution(aggregated, item='last-json-highest_rating',
     return fig
 
 
-def all_series_progression(data, **kwargs):
+# float values of a column, time deltas in hours
+def _floats(series):
+    if pd.api.types.is_timedelta64_dtype(series):
+        series = series.dt.total_seconds() / 3600
+    return pd.to_numeric(series, errors='coerce').to_numpy(
+        dtype='float64', na_value=np.nan)
 
-    fig = plt.figure()
 
-    for series in data.values():
-        series.set_index('index-rel-upload')['json-rating'].plot.line(
-            ax=fig.gca(),
-            color='black',
-            linewidth=3,
-            alpha=0.025)
+# points along the lines between consecutive points of the same photo, so
+# that a histogram of them approximates the drawn lines
+def _segment_points(x, y, photo_ids, samples=8):
+    same = photo_ids[1:] == photo_ids[:-1]
+    x0, x1 = x[:-1][same], x[1:][same]
+    y0, y1 = y[:-1][same], y[1:][same]
+    steps = np.linspace(0., 1., samples, endpoint=False)
+    return (np.concatenate([(x0[:, None] + (x1 - x0)[:, None] * steps).ravel(),
+                            x]),
+            np.concatenate([(y0[:, None] + (y1 - y0)[:, None] * steps).ravel(),
+                            y]))
+
+
+# 2D histogram of the points drawn as a single image with logarithmic colors
+def density_plot(ax, x, y, bins=200):
+    valid = np.isfinite(x) & np.isfinite(y)
+    counts, x_edges, y_edges = np.histogram2d(x[valid], y[valid], bins=bins)
+    mesh = ax.pcolormesh(x_edges, y_edges,
+                         np.ma.masked_equal(counts.T, 0),
+                         norm=LogNorm(), cmap='Greys')
+    ax.figure.colorbar(mesh, ax=ax, label='count')
+    return mesh
+
+
+# density renders a histogram of all progressions with a cost independent
+# of the number of photos, hours since upload on the x axis
+def all_series_progression(data, density=False, bins=200, **kwargs):
+
+    fig = plt.figure()
+    frame = as_frame(data)
+
+    if density:
+        x, y = _segment_points(
+            _floats(frame['index-rel-upload']), _floats(frame['json-rating']),
+            frame.index.get_level_values('photo_id').codes)
+        density_plot(fig.gca(), x, y, bins)
+        fig.gca().set_xlabel('hours since upload')
+        fig.gca().set_ylabel('json-rating')
+    else:
+        for _, series in frame.groupby(level='photo_id', observed=True,
+                                       sort=False):
+            series.set_index('index-rel-upload')['json-rating'].plot.line(
+                ax=fig.gca(),
+                color='black',
+                linewidth=3,
+                alpha=0.025)
 
     apply_standard_args(fig.gca(), **kwargs)
 
     return fig
 
 
+# density renders a histogram of the points instead of the single points
 def aggregated_scatter(aggregated,
                        x='first-json-user-affection',
                        y='last-json-highest_rating',
+                       density=False, bins=200,
                        **kwargs):
 
     fig = plt.figure()
-    aggregated.plot.scatter(x=x, y=y, ax=fig.gca())
+    if density:
+        density_plot(fig.gca(), _floats(aggregated[x]),
+                     _floats(aggregated[y]), bins)
+        fig.gca().set_xlabel(x)
+        fig.gca().set_ylabel(y)
+    else:
+        aggregated.plot.scatter(x=x, y=y, ax=fig.gca())
     apply_standard_args(fig.gca(), **kwargs)
     return fig
 
 
 def difference_of_followers(data, **kwargs):
 
-    points = []
-    for series in data.values():
-        points.append((series.iloc[-1]['json-highest_rating'],
-                       series.iloc[-1]['json-user-followers_count'] -
-                       series.iloc[0]['json-user-followers_count']))
-    frame = pd.DataFrame(points,
-                         columns=['json-highest_rating',
-                                  'delta-followers'])
+    frame = window_aggregate(
+        as_frame(data), ['json-highest_rating', 'json-user-followers_count'],
+        functions=('last', 'delta'))
+    frame = frame.rename(columns={
+        'last-json-highest_rating': 'json-highest_rating',
+        'delta-json-user-followers_count': 'delta-followers'})
 
     fig = plt.figure()
 
@@ -182,7 +554,13 @@ def difference_of_followers(data, **kwargs):
     return fig
 
 
-def feature_importances(aggregated, **kwargs):
+# target of the feature table
+TARGET = 'last-json-highest_rating'
+
+
+# numeric features per photo at upload time plus the target column, all as
+# float32 with NaN for missing values
+def feature_table(aggregated):
 
     feature_keys = ['json-category', 'meta-latitude',
                     'meta-longitude', 'meta-tags-count', 'meta-title',
@@ -214,20 +592,93 @@ def feature_importances(aggregated, **kwargs):
     features['first-json-user-about'] = features[
         'first-json-user-about'].str.len()
     features['first-json-user-analytics_code'] = features[
-        'first-json-user-about'].astype(bool)
-
-    forest = ExtraTreesRegressor(n_estimators=250)
-
-    forest.fit(features.fillna(features.mean()),
-               aggregated['last-json-highest_rating'])
-    std = np.std([tree.feature_importances_ for tree in forest.estimators_],
-                 axis=0)
-    std = pd.Series(std, index=features.columns)
-    importances = pd.Series(forest.feature_importances_,
-                            index=features.columns)
-
-    importances = importances.sort_values(ascending=False)
-    std = std.reindex_like(importances)
+        'first-json-user-about'].fillna(0).astype(bool)
+
+    features[TARGET] = aggregated[TARGET]
+    return features.astype('float32')
+
+
+def cached_features(files, processes=None):
+    return cached_table('features', files, FEATURES_VERSION,
+                        lambda: feature_table(cached_aggregate(files,
+                                                               processes)),
+                        AGGREGATE_VERSION)
+
+
+def _fit_forest(arguments):
+    train_x, train_y, test_x, test_y, n_estimators, n_jobs, seed = arguments
+    started = time.time()
+    forest = ExtraTreesRegressor(n_estimators=n_estimators, n_jobs=n_jobs,
+                                 random_state=seed)
+    forest.fit(train_x, train_y)
+    score = forest.score(test_x, test_y) if test_x is not None else None
+    tree_importances = np.array([tree.feature_importances_
+                                 for tree in forest.estimators_])
+    return (forest.feature_importances_, tree_importances, score,
+            time.time() - started)
+
+
+# Fits an ExtraTreesRegressor to a table from feature_table, repeats times
+# or per fold of a cv-fold cross validation. A single fit uses all cores,
+# several fits run in a pool of processes. Missing features are replaced by
+# the mean of their column. Returns a dict with the mean importances and
+# their std over all trees, test scores of the folds, the seconds of every
+# fit and the total seconds.
+def fit_importances(features, n_estimators=250, repeats=1, cv=None,
+                    processes=None, seed=0):
+    started = time.time()
+    features = features[features[TARGET].notna()]
+    target = features[TARGET].to_numpy()
+    names = features.columns.drop(TARGET)
+    matrix = features[names].to_numpy(dtype='float32', copy=True)
+    with warnings.catch_warnings():
+        # columns without any value are set to zero
+        warnings.simplefilter('ignore', RuntimeWarning)
+        means = np.nan_to_num(np.nanmean(matrix, axis=0))
+    missing = np.isnan(matrix)
+    matrix[missing] = np.take(means, np.nonzero(missing)[1])
+
+    runs = []
+    for repeat in range(repeats):
+        if cv:
+            folds = KFold(cv, shuffle=True, random_state=seed + repeat)
+            runs.extend((matrix[train], target[train], matrix[test],
+                         target[test], seed + repeat)
+                        for train, test in folds.split(matrix))
+        else:
+            runs.append((matrix, target, None, None, seed + repeat))
+
+    if len(runs) == 1:
+        results = [_fit_forest(runs[0][:4] + (n_estimators, -1, seed))]
+    else:
+        with multiprocessing.Pool(processes) as pool:
+            results = pool.map(_fit_forest, [run[:4] + (n_estimators, 1,
+                                                        run[4])
+                                             for run in runs])
+
+    tree_importances = np.concatenate([result[1] for result in results])
+    return {
+        'importances': pd.Series(
+            np.mean([result[0] for result in results], axis=0), index=names),
+        'std': pd.Series(tree_importances.std(axis=0), index=names),
+        'scores': [result[2] for result in results
+                   if result[2] is not None],
+        'fit_seconds': [result[3] for result in results],
+        'seconds': time.time() - started,
+    }
+
+
+# features is an optional table from feature_table or cached_features,
+# repeats and cv are passed to fit_importances
+def feature_importances(aggregated, features=None, repeats=1, cv=None,
+                        **kwargs):
+
+    if features is None:
+        features = feature_table(aggregated)
+    result = fit_importances(features, repeats=repeats, cv=cv)
+
+    importances = result['importances'].sort_values(ascending=False)
+    std = result['std'].reindex_like(importances)
 
     fig = plt.figure()
 
@@ -238,9 +689,15 @@ def feature_importances(aggregated, **kwargs):
     return fig
 
 
-def std_eval(data):
+# without data, the aggregated table is derived from files (default:
+# get_files()) through the cache
+def std_eval(data=None, files=None):
 
-    aggregated = aggregate(data)
+    if data is None:
+        aggregated = cached_aggregate(get_files() if files is None
+                                      else files)
+    else:
+        aggregated = aggregate(data)
 
     figures = []
 
@@ -351,3 +808,5 @@ def std_eval(data):
     #     all_series_progression(
     #         data,
     #         title="evolution of rating"))
+
+    return figures
@@ -0,0 +1,32 @@
+import html
+import re
+
+AUTHOR_META = re.compile(
+    rb'<meta\s(?:[^>]*\s)?property\s*=\s*(["\'])'
+    rb'five_hundred_pixels:author\1[^>]*>', re.IGNORECASE)
+CONTENT_ATTRIBUTE = re.compile(
+    rb'\scontent\s*=\s*(["\'])(.*?)\1', re.IGNORECASE | re.DOTALL)
+HEAD_END = b'</head>'
+
+
+# Finds the five_hundred_pixels:author meta tag in a stream of byte chunks of
+# a photo page without building a DOM. Stops reading at the end of the head.
+def find_user_url(chunks):
+    buffer = b''
+    for chunk in chunks:
+        buffer += chunk
+        match = AUTHOR_META.search(buffer)
+        if match:
+            content = CONTENT_ATTRIBUTE.search(match.group(0))
+            if content:
+                return html.unescape(content.group(2).decode('utf-8'))
+            return None
+        if HEAD_END in buffer:
+            return None
+    return None
+
+
+def get_user_url(contents):
+    if isinstance(contents, str):
+        contents = contents.encode('utf-8')
+    return find_user_url([contents])
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import os.path
+import shutil
+import tempfile
+import threading
+import time
+
+from lxml import etree
+
+import pandas as pd
+
+import extract
+import synthetic
+
+
+# the parsers as they were before the compiled tables, used as a baseline
+def reference_parse_photo(contents):
+    root = etree.fromstring(contents, etree.HTMLParser(encoding='utf-8'))
+
+    data = {}
+    for xpath, target_key, parser in extract.PHOTO_XPATH_PARSE:
+        data[target_key] = parser(root.xpath(xpath))
+
+    json_data = json.loads(root.xpath(
+        "//script[contains(text(), "
+        "'window.PxPreloadedData')][1]/text()")[0].strip().replace(
+            'window.PxPreloadedData = ', '')[:-1])['photo']
+    user_data = json_data['user'] or {}
+    for source, table in [(json_data, extract.PHOTO_JSON_PARSE),
+                          (user_data, extract.PHOTO_JSON_USER_PARSE)]:
+        for entry, target_key, parser in table:
+            try:
+                if entry in source and source[entry] is not None:
+                    data[target_key] = parser(source[entry])
+                else:
+                    data[target_key] = None
+            except Exception:
+                data[target_key] = None
+
+    return data
+
+
+def reference_parse_user(contents):
+    root = etree.fromstring(contents, etree.HTMLParser(encoding='utf-8'))
+
+    data = {}
+    for xpath, target_key, parser in extract.USER_XPATH_PARSE:
+        data[target_key] = parser(root.xpath(xpath))
+
+    return data
+
+
+def collect_pages(archives):
+    pages = {page: [] for page in extract.PAGE_PARSERS}
+    for archive in archives:
+        for _, snapshot in extract.archive_snapshots(archive):
+            for page, contents in snapshot.items():
+                if contents is not None:
+                    pages[page].append(contents)
+    return pages
+
+
+# frame of parsed pages with the column types of extract.py
+def converted(results):
+    columns = {}
+    for row, data in enumerate(results):
+        for key, value in data.items():
+            if key != extract.FAILED:
+                columns.setdefault(key, [None] * len(results))[row] = value
+    return extract.apply_schema(
+        columns, pd.RangeIndex(len(results)),
+        {column: extract.SCHEMA[column] for column in columns})
+
+
+# returns snapshots per second of the fastest of repeat runs, optionally
+# including the conversion of the parsed columns
+def time_parser(parser, pages, repeat=3, convert=False):
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        results = [parser(contents) for contents in pages]
+        if convert:
+            converted(results)
+        best = min(best, time.perf_counter() - started)
+    return len(pages) / best if best else float('inf')
+
+
+def benchmark_parsers(pages, repeat=3):
+    results = {}
+    for page, compiled, reference in [
+            ('photo', extract.parse_photo, reference_parse_photo),
+            ('user', extract.parse_user, reference_parse_user)]:
+        if not pages[page]:
+            continue
+
+        expected = converted([reference(contents)
+                              for contents in pages[page]])
+        actual = converted([compiled(contents) for contents in pages[page]])
+        mismatches = [column for column in expected
+                      if column not in actual or
+                      not expected[column].equals(actual[column])]
+
+        results[page] = {
+            'snapshots': len(pages[page]),
+            'reference': time_parser(reference, pages[page], repeat),
+            'compiled': time_parser(compiled, pages[page], repeat,
+                                    convert=True),
+            'mismatches': mismatches,
+        }
+    return results
+
+
+def print_parser_results(results):
+    for page, result in results.items():
+        print('{}: {} snapshots, reference {:.1f}/s, compiled {:.1f}/s '
+              '(x{:.2f})'.format(page, result['snapshots'],
+                                 result['reference'], result['compiled'],
+                                 result['compiled'] / result['reference']))
+        if result['mismatches']:
+            print('  differing fields: {}'.format(
+                ', '.join(result['mismatches'])))
+
+
+# resident set size of this process in bytes
+def _rss():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+# Returns the result of function, its wall time in seconds and the peak
+# growth of the resident set size meanwhile in bytes. The size is sampled
+# from a thread, so that it also covers memory allocated outside of Python
+# like the memory pool of Arrow.
+def measure(function, *args, interval=0.005, **kwargs):
+    baseline = _rss()
+    peak = [baseline]
+    stop = threading.Event()
+
+    def sample():
+        while not stop.wait(interval):
+            peak[0] = max(peak[0], _rss())
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    started = time.perf_counter()
+    try:
+        result = function(*args, **kwargs)
+        seconds = time.perf_counter() - started
+    finally:
+        stop.set()
+        sampler.join()
+    return result, seconds, max(peak[0], _rss()) - baseline
+
+
+# archives per second of extract.main with the given processes
+def benchmark_extraction(archives, out_dir, processes=None):
+    argv = list(archives) + ['-o', out_dir, '--force']
+    if processes:
+        argv += ['-j', str(processes)]
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        status = extract.main(argv)
+    seconds = time.perf_counter() - started
+    if status:
+        raise RuntimeError('Extraction failed')
+    return len(archives) / seconds
+
+
+# (step, seconds, peak memory growth in bytes) for loading the extracted progressions,
+# aggregating them and fitting the feature importances
+def benchmark_analysis(files):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import analysis
+
+    data, seconds, peak = measure(analysis.load_data, files)
+    results = [('load_data', seconds, peak)]
+    aggregated, seconds, peak = measure(analysis.aggregate, data)
+    results.append(('aggregate', seconds, peak))
+    figure, seconds, peak = measure(analysis.feature_importances, aggregated)
+    plt.close(figure)
+    results.append(('feature_importances', seconds, peak))
+    return results
+
+
+def print_analysis_results(results):
+    for step, seconds, peak in results:
+        print('{}: {:.2f}s, peak memory growth {:.1f} MiB'.format(
+            step, seconds, peak / 2 ** 20))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmarks the snapshot parsers of extract.py, the '
+                    'extraction and the analysis on archives or on '
+                    'synthetic ones')
+    parser.add_argument('archives', nargs='*', metavar='ARCHIVE')
+    parser.add_argument('-r', '--repeat', type=int, default=3)
+    parser.add_argument('-n', '--photos', type=int, default=20,
+                        help='synthetic archives without given archives')
+    parser.add_argument('-s', '--snapshots', type=int, default=48,
+                        help='snapshots per synthetic archive')
+    parser.add_argument('-j', '--processes', type=int, default=None,
+                        help='extraction processes (default: CPUs)')
+    parser.add_argument('--parsers-only', action='store_true',
+                        help='only benchmark the parsers')
+    args = parser.parse_args(argv)
+
+    work_dir = tempfile.mkdtemp(prefix='benchmark-')
+    try:
+        archives = args.archives
+        if not archives:
+            archives = synthetic.generate(work_dir, args.photos,
+                                          args.snapshots)
+
+        print_parser_results(benchmark_parsers(collect_pages(archives),
+                                               args.repeat))
+        if args.parsers_only:
+            return
+
+        print('extraction: {:.2f} archives/s'.format(benchmark_extraction(
+            archives, work_dir, args.processes)))
+        manifest = extract.Manifest(os.path.join(work_dir, extract.MANIFEST))
+        print_analysis_results(benchmark_analysis(
+            [entry['output'] for entry in manifest.entries.values()]))
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    main()
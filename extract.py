@@ -1,24 +1,84 @@
 #!/usr/bin/env python3
 
+import argparse
+import collections
+import contextlib
+import copy
+import functools
+import glob
+import hashlib
+import io
 import json
+import multiprocessing
 import os.path
 import re
 import subprocess
 import sys
-import tempfile
+import tarfile
+import time
+import traceback
 
 from lxml import etree
 
+import numpy as np
 import pandas as pd
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
-OUT = '/media/data/500px-progressions-processed/'
+import snapshots
 
 
-def extract(archive, temp_dir):
-    subprocess.check_call(
-        'brotli -c -d {} | tar -xf - --strip=2'.format(archive),
-        shell=True, cwd=temp_dir)
+OUT = '/media/data/500px-progressions-processed/'
+# name of the manifest of extracted inputs in the output directory
+MANIFEST = 'manifest.json'
+
+
+# decompressing file object on top of a brotli compressed one
+class BrotliReader(io.RawIOBase):
+
+    def __init__(self, compressed, chunk_size=1 << 16):
+        self.compressed = compressed
+        self.chunk_size = chunk_size
+        self.decompressor = brotli.Decompressor()
+        # decompressed chunk and the position up to which it has been read
+        self.buffer = memoryview(b'')
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, target):
+        while self.position == len(self.buffer):
+            chunk = self.compressed.read(self.chunk_size)
+            if not chunk:
+                return 0
+            self.buffer = memoryview(self.decompressor.process(chunk))
+            self.position = 0
+        size = min(len(target), len(self.buffer) - self.position)
+        target[:size] = self.buffer[self.position:self.position + size]
+        self.position += size
+        return size
+
+
+@contextlib.contextmanager
+def open_archive(archive):
+    if brotli is not None:
+        with open(archive, 'rb') as compressed:
+            yield io.BufferedReader(BrotliReader(compressed))
+    else:
+        # stream from the brotli binary if the module is not installed
+        process = subprocess.Popen(['brotli', '-c', '-d', archive],
+                                   stdout=subprocess.PIPE)
+        try:
+            yield process.stdout
+        finally:
+            process.stdout.close()
+            if process.wait() != 0:
+                raise subprocess.CalledProcessError(process.returncode,
+                                                    process.args)
 
 
 class ParsingTree(object):
@@ -153,42 +213,91 @@ PHOTO_JSON_USER_PARSE = [
 ]
 
 
-def parse_photo(folder):
-    parser = etree.HTMLParser()
-    with open(os.path.join(folder, "photo.html")) as html_file:
-        root = etree.parse(html_file, parser)
+PRELOADED_DATA_MARKER = b'window.PxPreloadedData = '
+SCRIPT_END = b'</script>'
+HEAD_END = b'</head>'
 
-    data = {}
+# converters of the parse tables which are applied to whole columns by
+# apply_schema instead of to every single value
+COLUMN_CONVERTERS = (str, int, float, bool, pd.to_datetime)
 
-    # Generic XPath parsing
-    for xpath, target_key, parser in PHOTO_XPATH_PARSE:
-        data[target_key] = parser(root.xpath(xpath))
+# key of the parsed data listing the fields which could not be parsed
+FAILED = '_failed'
+
+
+def _plain(value):
+    # strings of xpath results keep their whole document alive
+    return str(value) if isinstance(value, str) else value
+
+
+# the parser without its final conversion if that is done per column
+def raw_parser(parser):
+    if isinstance(parser, ParsingTree):
+        raw = copy.copy(parser)
+        raw.target = raw_parser(parser.target)
+        return raw
+    if parser in COLUMN_CONVERTERS:
+        return _plain
+    return parser
+
+
+# XPath expressions of a parse table compiled once. If all expressions only
+# look at meta tags, documents are parsed up to the end of their head.
+class CompiledXPathTable(object):
+
+    def __init__(self, table):
+        self.fields = [(etree.XPath(xpath), target_key, raw_parser(parser))
+                       for xpath, target_key, parser in table]
+        self.head_only = all(
+            re.sub(r'^count\(', '', xpath).startswith('//meta')
+            for xpath, _, _ in table)
+
+    def parse(self, contents):
+        if self.head_only:
+            head_end = contents.find(HEAD_END)
+            if head_end >= 0:
+                contents = contents[:head_end + len(HEAD_END)]
+        # parsers are reused and thus must not be shared between threads
+        return etree.fromstring(contents, HTML_PARSER)
+
+    def apply(self, root, data):
+        for xpath, target_key, parser in self.fields:
+            data[target_key] = parser(xpath(root))
+        return data
+
+
+def preloaded_data(contents):
+    start = contents.find(PRELOADED_DATA_MARKER)
+    if start < 0:
+        raise ValueError('No preloaded data in page')
+    start += len(PRELOADED_DATA_MARKER)
+    end = contents.find(SCRIPT_END, start)
+    # strip the trailing semicolon of the assignment
+    return json.loads(contents[start:end].strip()[:-1])
 
-    # Special JSON parsing of preload data
-    json_data = json.loads(root.xpath(
-        "//script[contains(text(), "
-        "'window.PxPreloadedData')][1]/text()")[0].strip().replace(
-            'window.PxPreloadedData = ', '')[:-1])['photo']
-    for entry, target_key, parser in PHOTO_JSON_PARSE:
-        try:
-            if entry in json_data and json_data[entry] is not None:
-                data[target_key] = parser(json_data[entry])
-            else:
-                data[target_key] = None
-        except:
-            print(entry)
-            data[target_key] = None
 
-    user_data = json_data['user'] or {}
-    for entry, target_key, parser in PHOTO_JSON_USER_PARSE:
+def _apply_json(source, fields, data):
+    for entry, target_key, parser in fields:
+        value = source.get(entry)
+        if value is None:
+            data[target_key] = None
+            continue
         try:
-            if entry in user_data and user_data[entry] is not None:
-                data[target_key] = parser(user_data[entry])
-            else:
-                data[target_key] = None
-        except:
-            print(entry)
+            data[target_key] = parser(value)
+        except Exception:
             data[target_key] = None
+            data.setdefault(FAILED, []).append(target_key)
+
+
+# Raw values of a photo page, converted to the types of the tables by
+# apply_schema.
+def parse_photo(contents):
+    data = PHOTO_XPATH.apply(PHOTO_XPATH.parse(contents), {})
+
+    # Special JSON parsing of preload data
+    json_data = preloaded_data(contents)['photo']
+    _apply_json(json_data, PHOTO_JSON_FIELDS, data)
+    _apply_json(json_data['user'] or {}, PHOTO_JSON_USER_FIELDS, data)
 
     return data
 
@@ -218,39 +327,528 @@ USER_XPATH_PARSE = [
 ]
 
 
-def parse_user(folder):
-    parser = etree.HTMLParser()
-    with open(os.path.join(folder, "user.html")) as html_file:
-        root = etree.parse(html_file, parser)
-
-    data = {}
+def parse_user(contents):
+    return USER_XPATH.apply(USER_XPATH.parse(contents), {})
 
-    for xpath, target_key, parser in USER_XPATH_PARSE:
-        data[target_key] = parser(root.xpath(xpath))
-
-    return data
 
+# free text columns, all other string columns are dictionary encoded
+FREE_TEXT_COLUMNS = [
+    'meta-title',
+    'meta-description',
+    'json-location',
+    'json-user-about',
+]
 
-def main(archive):
-
-    with tempfile.TemporaryDirectory() as temp_dir:
-        extract(archive, temp_dir)
-
-        # iterate all timestamped folders
-        all_data = {}
-        for folder in [os.path.join(temp_dir, candidate)
-                       for candidate in os.listdir(temp_dir)
-                       if os.path.isdir(os.path.join(temp_dir, candidate))]:
-            date = pd.to_datetime(os.path.basename(folder), unit='s')
-            data = parse_photo(folder)
-            data.update(parse_user(folder))
-            all_data[date] = data
-
-        all_data = pd.DataFrame.from_dict(all_data, orient='index')
-        all_data.to_msgpack(os.path.join(
-            OUT,
-            os.path.basename(archive).split('-')[0] + '.msg'))
+# pandas data types for the results of the parsers used in the tables
+PARSER_DTYPES = {
+    str: 'category',
+    int: 'Int64',
+    len: 'Int64',
+    float: 'float64',
+    bool: 'boolean',
+    pd.to_datetime: 'datetime64[ns]',
+}
+
+
+def _result_type(parser):
+    while isinstance(parser, ParsingTree):
+        parser = parser.target
+    return parser
+
+
+# column -> pandas data type for all columns of an extracted progression
+def progression_schema():
+    schema = {}
+    for table in [PHOTO_XPATH_PARSE, USER_XPATH_PARSE]:
+        for _, target_key, parser in table:
+            schema[target_key] = PARSER_DTYPES[_result_type(parser)]
+    for table in [PHOTO_JSON_PARSE, PHOTO_JSON_USER_PARSE]:
+        for _, target_key, parser in table:
+            schema[target_key] = PARSER_DTYPES[parser]
+    for column in FREE_TEXT_COLUMNS:
+        schema[column] = 'string'
+    return schema
+
+
+# parsing of the timestamps in the pages, which all use ISO 8601
+DATETIME_FORMAT = 'ISO8601' if int(pd.__version__.split('.')[0]) >= 2 \
+    else None
+
+
+def _convert(values, dtype):
+    if dtype == 'datetime64[ns]':
+        # timestamps are normalized to UTC without time zone, like the index
+        return pd.to_datetime(values, utc=True, errors='coerce',
+                              format=DATETIME_FORMAT).dt.tz_localize(
+                                  None).astype(dtype)
+    elif dtype in ('Int64', 'float64'):
+        values = pd.to_numeric(values, errors='coerce')
+        if dtype == 'Int64':
+            # like int(), fractions are truncated
+            values = np.trunc(values.where(np.isfinite(values)))
+        return values.astype(dtype)
+    elif dtype == 'boolean':
+        present = values.notna()
+        converted = pd.Series(pd.NA, index=values.index, dtype=dtype)
+        converted[present] = values[present].astype(bool)
+        return converted
+    elif dtype == 'category':
+        # string categories also for columns without any value
+        return values.astype('string').astype(dtype)
+    return values.astype(dtype)
+
+
+# Converts columns of raw values (any sequence, missing columns are empty)
+# to a frame with the types of the schema, one conversion per column.
+# failures counts the values per column which could not be converted.
+def apply_schema(columns, index, schema, failures=None):
+    frame = {}
+    for column, dtype in schema.items():
+        values = pd.Series(columns.get(column), index=index, dtype=object)
+        frame[column] = _convert(values, dtype)
+        if failures is not None:
+            failed = int((values.notna() & frame[column].isna()).sum())
+            if failed:
+                failures[column] += failed
+    return pd.DataFrame(frame, index=index)
+
+
+SCHEMA = progression_schema()
+
+HTML_PARSER = etree.HTMLParser(encoding='utf-8')
+PHOTO_XPATH = CompiledXPathTable(PHOTO_XPATH_PARSE)
+USER_XPATH = CompiledXPathTable(USER_XPATH_PARSE)
+PHOTO_JSON_FIELDS = [(entry, target_key, raw_parser(parser))
+                     for entry, target_key, parser in PHOTO_JSON_PARSE]
+PHOTO_JSON_USER_FIELDS = [(entry, target_key, raw_parser(parser))
+                          for entry, target_key, parser
+                          in PHOTO_JSON_USER_PARSE]
+
+
+PAGE_PARSERS = {
+    'photo': parse_photo,
+    'user': parse_user,
+}
+
+
+# increase when the parsing code changes in ways the tables do not show
+EXTRACT_VERSION = 2
+
+
+def _describe(parser):
+    if isinstance(parser, ParsingTree):
+        return [type(parser).__name__, _describe(parser.target),
+                getattr(parser, 'search', None),
+                getattr(parser, 'replace', None)]
+    return '{}.{}'.format(parser.__module__, parser.__qualname__)
+
+
+# hash of everything that defines the extracted columns, stored with every
+# output so that outputs of changed tables are extracted again
+def parser_version():
+    definition = [EXTRACT_VERSION, sorted(SCHEMA.items())]
+    for table in [PHOTO_XPATH_PARSE, PHOTO_JSON_PARSE, PHOTO_JSON_USER_PARSE,
+                  USER_XPATH_PARSE]:
+        definition.append([[source, target_key, _describe(parser)]
+                           for source, target_key, parser in table])
+    return hashlib.sha256(json.dumps(definition).encode('utf-8')).hexdigest()
+
+
+PARSER_VERSION = parser_version()
+
+
+# (timestamp, {page: contents}) for the timestamped folders of a tar.br
+# archive, read as a stream without extracting it. Contents are None for
+# pages marked as unchanged and snapshots are not necessarily ordered. Folders
+# without all pages (failed fetches) are skipped.
+def archive_snapshots(archive):
+    incomplete = {}
+    with open_archive(archive) as stream:
+        with tarfile.open(fileobj=stream, mode='r|') as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                parts = member.name.split('/')
+                if len(parts) < 2 or not parts[-2].isdigit():
+                    continue
+                page, _, kind = parts[-1].partition('.')
+                if page not in PAGE_PARSERS or \
+                        kind not in ('html', 'unchanged'):
+                    continue
+
+                timestamp = int(parts[-2])
+                pages = incomplete.setdefault(timestamp, {})
+                pages[page] = tar.extractfile(member).read() \
+                    if kind == 'html' else None
+                if len(pages) == len(snapshots.PAGES):
+                    yield timestamp, incomplete.pop(timestamp)
+
+
+# Bounded LRU cache from the hash of a page to its parsed result, so that
+# byte-identical pages are only parsed once.
+class ParseCache(object):
+
+    def __init__(self, parser, size=256):
+        self.parser = parser
+        self.size = size
+        self.entries = collections.OrderedDict()
+
+    def clear(self):
+        self.entries.clear()
+
+    # returns the parsed result and whether it came from the cache
+    def parse(self, contents):
+        key = hashlib.blake2b(contents, digest_size=16).digest()
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return dict(self.entries[key]), True
+
+        data = self.parser(contents)
+        self.entries[key] = data
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+        return dict(data), False
+
+
+# one cache per page kind and process, shared by all snapshots it parses
+PARSE_CACHES = {page: ParseCache(parser)
+                for page, parser in PAGE_PARSERS.items()}
+# consecutive snapshots parsed by the same process of a pool, so that pages
+# repeating between them hit its caches
+SNAPSHOT_CHUNK_SIZE = 32
+
+# (task, share_users) of the task being extracted, set by run_task
+_task_scope = None
+# scope of the pages in the caches of this process
+_cache_scope = None
+
+
+# The caches of a process are cleared when it parses the snapshots of
+# another task, also in the processes of a pool. Cached user pages are kept
+# if share_users is set.
+def _parse_snapshot(snapshot, scope=None):
+    global _cache_scope
+    if scope != _cache_scope:
+        PARSE_CACHES['photo'].clear()
+        if scope is None or not scope[1]:
+            PARSE_CACHES['user'].clear()
+        _cache_scope = scope
+
+    timestamp, pages = snapshot
+    parsed = [timestamp]
+    hits = 0
+    for page in snapshots.PAGES:
+        if pages[page] is None:
+            parsed.append(None)
+        else:
+            data, hit = PARSE_CACHES[page].parse(pages[page])
+            parsed.append(data)
+            hits += hit
+    return tuple(parsed), hits
+
+
+# pool optionally parses the snapshots in parallel, stats counts parsed pages
+# and cache hits, failures counts the values per column which could not be
+# parsed or converted
+def parse_snapshots(timestamped_pages, pool=None, stats=None, failures=None):
+
+    parse = functools.partial(_parse_snapshot, scope=_task_scope)
+    if pool is None:
+        results = map(parse, timestamped_pages)
+    else:
+        results = pool.imap(parse, timestamped_pages,
+                            chunksize=SNAPSHOT_CHUNK_SIZE)
+
+    parsed = []
+    for snapshot, hits in results:
+        parsed.append(snapshot)
+        if stats is not None:
+            stats['pages'] += sum(data is not None for data in snapshot[1:])
+            stats['hits'] += hits
+
+    parsed.sort(key=lambda snapshot: snapshot[0])
+
+    # pages marked as unchanged (parsed as None) reuse the last parsed result
+    # in temporal order, snapshots before both pages have been parsed once
+    # are skipped
+    rows = []
+    photo_data = None
+    user_data = None
+    for timestamp, photo_parsed, user_parsed in parsed:
+        if photo_parsed is not None:
+            photo_data = photo_parsed
+        if user_parsed is not None:
+            user_data = user_parsed
+        if photo_data is not None and user_data is not None:
+            rows.append((timestamp, photo_data, user_data))
+
+    index = pd.DatetimeIndex(
+        pd.to_datetime([row[0] for row in rows], unit='s'), name='time')
+
+    # raw values are collected per column and converted at once
+    columns = {column: [None] * len(rows) for column in SCHEMA}
+    for row, (_, photo_data, user_data) in enumerate(rows):
+        for data in (photo_data, user_data):
+            for column, value in data.items():
+                if column == FAILED:
+                    if failures is not None:
+                        failures.update(value)
+                else:
+                    columns[column][row] = value
+
+    return apply_schema(columns, index, SCHEMA, failures)
+
+
+# compressed columnar file which can be read column by column. The file is
+# written under a temporary name and renamed, so it is either complete or
+# missing. Returns the path of the file.
+def write_progression(frame, photo_id, out_dir=OUT):
+    path = os.path.join(out_dir, '{}.parquet'.format(photo_id))
+    temp_path = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        frame.to_parquet(temp_path, engine='pyarrow', compression='zstd')
+        with open(temp_path, 'rb') as f:
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return path
+
+
+def extract_archive(archive, out_dir=OUT, pool=None, stats=None,
+                    failures=None):
+
+    return write_progression(
+        parse_snapshots(archive_snapshots(archive), pool, stats, failures),
+        os.path.basename(archive).split('-')[0], out_dir)
+
+
+def extract_stored_photo(directory, photo_id, out_dir=OUT, pool=None,
+                         stats=None, failures=None):
+    store = snapshots.SnapshotStore(directory)
+    return write_progression(
+        parse_snapshots(store.snapshots(photo_id), pool, stats, failures),
+        photo_id, out_dir)
+
+
+def _file_hash(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# size and mtime of the input of a task, with the content hash only for
+# snapshot stores where it is cheap to compute from the index
+def task_stat(task, stores=None):
+    if task[0] == 'store':
+        if stores is None:
+            stores = {}
+        if task[1] not in stores:
+            stores[task[1]] = snapshots.SnapshotStore(task[1])
+        return stores[task[1]].fingerprint(task[2])
+    stat = os.stat(task[1])
+    return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+# Records for every task the input (size, mtime, content hash), the parser
+# version and the output it has been extracted to. Saved as a JSON file
+# which is replaced atomically.
+class Manifest(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+
+    def get(self, task):
+        return self.entries.get(_task_name(task))
+
+    def record(self, task, entry):
+        self.entries[_task_name(task)] = entry
+
+    # whether the output of the task is current without hashing its input
+    def up_to_date(self, task, stat):
+        entry = self.get(task)
+        return entry is not None and \
+            entry['parser'] == PARSER_VERSION and \
+            os.path.exists(entry['output']) and \
+            all(entry.get(key) == value for key, value in stat.items())
+
+    def save(self):
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+
+
+# one task per archive and per finished photo of snapshot stores; paths are
+# archives, directories of archives, glob patterns or snapshot stores written
+# by progressions.py
+def collect_tasks(paths):
+    tasks = []
+    for path in paths:
+        if snapshots.SnapshotStore.exists(path):
+            store = snapshots.SnapshotStore(path)
+            tasks.extend(('store', path, photo_id)
+                         for photo_id in sorted(store.photo_ids(
+                             finished=True)))
+        elif os.path.isdir(path):
+            tasks.extend(('archive', archive)
+                         for archive in sorted(glob.glob(
+                             os.path.join(path, '*.tar.br'))))
+        else:
+            tasks.extend(('archive', archive)
+                         for archive in sorted(glob.glob(path)) or [path])
+    return tasks
+
+
+def _task_name(task):
+    if task[0] == 'store':
+        return '{}:{}'.format(task[1], task[2])
+    return task[1]
+
+
+# Returns a dict with the task, seconds, error, stats, conversion failures per
+# column and the new manifest entry, so that a broken input only fails its
+# task. If the input has the
+# same content hash as in the previous entry, only its stat is updated
+# (reused). Photo pages never repeat across photos, so their cache is
+# cleared for every task; cached user pages are kept if share_users is set.
+def run_task(task, out_dir=OUT, pool=None, share_users=False,
+             previous=None):
+    global _task_scope
+    started = time.time()
+    result = {'task': task, 'error': None, 'stats': collections.Counter(),
+              'failures': collections.Counter(), 'entry': None,
+              'reused': False}
+    _task_scope = (task, share_users)
+    try:
+        entry = task_stat(task)
+        if 'hash' not in entry:
+            entry['hash'] = _file_hash(task[1])
+        entry['parser'] = PARSER_VERSION
+
+        if previous is not None and previous['hash'] == entry['hash'] and \
+                previous['parser'] == PARSER_VERSION and \
+                os.path.exists(previous['output']):
+            entry['output'] = previous['output']
+            result['reused'] = True
+        elif task[0] == 'store':
+            entry['output'] = extract_stored_photo(
+                task[1], task[2], out_dir, pool, result['stats'],
+                result['failures'])
+        else:
+            entry['output'] = extract_archive(task[1], out_dir, pool,
+                                              result['stats'],
+                                              result['failures'])
+        result['entry'] = entry
+    except Exception:
+        result['error'] = traceback.format_exc()
+    result['seconds'] = time.time() - started
+    return result
+
+
+def _hit_rate(stats):
+    return stats['hits'] / stats['pages'] if stats['pages'] else 0.
+
+
+def _run_task_in_pool(arguments):
+    return run_task(*arguments)
+
+
+# Extracts all tasks which are not up to date according to the manifest in
+# the output directory, with a pool of processes. With fewer tasks than
+# processes the tasks run one after another and the snapshots of each task
+# are parsed in the pool instead. force extracts all tasks again.
+def batch(tasks, out_dir=OUT, processes=None, share_users=False,
+          force=False, save_interval=10):
+    processes = processes or multiprocessing.cpu_count()
+    manifest = Manifest(os.path.join(out_dir, MANIFEST))
+    stores = {}
+    pending = [task for task in tasks
+               if force or not manifest.up_to_date(task,
+                                                   task_stat(task, stores))]
+    print('{} of {} tasks up to date'.format(len(tasks) - len(pending),
+                                             len(tasks)))
+
+    failed = []
+    total = collections.Counter()
+    failures = collections.Counter()
+    started = last_save = time.time()
+    try:
+        with multiprocessing.Pool(processes) as pool:
+            arguments = [(task, out_dir, None, share_users,
+                          None if force else manifest.get(task))
+                         for task in pending]
+            if len(pending) >= processes:
+                results = pool.imap_unordered(_run_task_in_pool, arguments)
+            else:
+                results = (run_task(task, out_dir, pool, share_users,
+                                    previous)
+                           for task, _, _, _, previous in arguments)
+
+            for done, result in enumerate(results, 1):
+                name = _task_name(result['task'])
+                total.update(result['stats'])
+                failures.update(result['failures'])
+                if result['error']:
+                    failed.append(result['task'])
+                    print('[{}/{}] {} failed after {:.1f}s:\n{}'.format(
+                        done, len(pending), name, result['seconds'],
+                        result['error']))
+                    continue
+
+                manifest.record(result['task'], result['entry'])
+                if result['reused']:
+                    print('[{}/{}] {} unchanged'.format(done, len(pending),
+                                                        name))
+                else:
+                    print('[{}/{}] {} done in {:.1f}s, '
+                          'cache hit rate {:.2f}'.format(
+                              done, len(pending), name, result['seconds'],
+                              _hit_rate(result['stats'])))
+                if time.time() - last_save >= save_interval:
+                    manifest.save()
+                    last_save = time.time()
+    finally:
+        manifest.save()
+
+    print('{} tasks in {:.1f}s, {} failed, cache hit rate {:.2f}'.format(
+        len(pending), time.time() - started, len(failed), _hit_rate(total)))
+    for column, count in sorted(failures.items()):
+        print('  {}: {} values could not be converted'.format(column, count))
+    return failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Extracts progression archives or snapshot stores')
+    parser.add_argument('paths', nargs='+', metavar='PATH',
+                        help='archive, directory of archives, glob pattern '
+                             'or snapshot store')
+    parser.add_argument('-j', '--processes', type=int, default=None,
+                        help='number of worker processes (default: CPUs)')
+    parser.add_argument('-o', '--out', default=OUT,
+                        help='output directory (default: %(default)s)')
+    parser.add_argument('--share-user-cache', action='store_true',
+                        help='reuse parsed user pages across archives')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='extract up-to-date inputs again')
+    args = parser.parse_args(argv)
+
+    tasks = collect_tasks([os.path.abspath(path) for path in args.paths])
+    failed = batch(tasks, args.out, args.processes, args.share_user_cache,
+                   args.force)
+    return 1 if failed else 0
 
 
 if __name__ == "__main__":
-    main(os.path.abspath(sys.argv[1]))
+    sys.exit(main())
@@ -0,0 +1,70 @@
+import requests
+import requests.adapters
+
+# urllib3 only decodes brotli responses if one of the brotli modules is there
+try:
+    import brotli  # noqa: F401
+    ACCEPT_ENCODING = 'gzip, deflate, br'
+except ImportError:
+    ACCEPT_ENCODING = 'gzip, deflate'
+
+
+# seconds to connect and to wait for data of a response
+TIMEOUT = (10, 60)
+
+
+# applies a default timeout to requests without one, so that a hanging
+# connection fails instead of holding its pool slot forever
+class TimeoutHTTPAdapter(requests.adapters.HTTPAdapter):
+
+    __attrs__ = requests.adapters.HTTPAdapter.__attrs__ + ['timeout']
+
+    def __init__(self, timeout=TIMEOUT, **kwargs):
+        self.timeout = timeout
+        requests.adapters.HTTPAdapter.__init__(self, **kwargs)
+
+    def send(self, request, timeout=None, **kwargs):
+        if timeout is None:
+            timeout = self.timeout
+        return requests.adapters.HTTPAdapter.send(self, request,
+                                                  timeout=timeout, **kwargs)
+
+
+def create_session(pool_size=10, timeout=TIMEOUT):
+    # keep-alive connections are reused per host; pool_block ensures that no
+    # more than pool_size connections are ever opened to a single host
+    session = requests.Session()
+    adapter = TimeoutHTTPAdapter(timeout=timeout,
+                                 pool_connections=4,
+                                 pool_maxsize=pool_size,
+                                 pool_block=True)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers['Accept-Encoding'] = ACCEPT_ENCODING
+    return session
+
+
+def get_validators(response):
+    return (response.headers.get('ETag'),
+            response.headers.get('Last-Modified'))
+
+
+def conditional_get(session, url, validators=None, **kwargs):
+    headers = dict(kwargs.pop('headers', None) or {})
+    if validators:
+        etag, last_modified = validators
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+    return session.get(url, headers=headers, **kwargs)
+
+
+def is_unchanged(response):
+    return response.status_code == requests.codes.not_modified
+
+
+# either a new page or a confirmation that the last stored one is up to date
+def is_current(response):
+    return response.status_code == requests.codes.ok or \
+        is_unchanged(response)
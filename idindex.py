@@ -0,0 +1,175 @@
+import mmap
+import os
+import os.path
+import threading
+
+
+# Base for persistent indices. Every change is appended to a log as one line;
+# on opening, the log is folded into a compact snapshot with the same line
+# format. Loading only reads these two files, independent of how the indexed
+# data is stored elsewhere.
+class _LoggedIndex(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.log_path = path + '.log'
+        self.created = not (os.path.exists(path) or
+                            os.path.exists(self.log_path))
+        self.lock = threading.Lock()
+        self.log = None
+
+        for file_path in [path, self.log_path]:
+            if os.path.exists(file_path):
+                with open(file_path) as f:
+                    for line in f:
+                        # ignore a partially written last line
+                        if line.endswith('\n'):
+                            self._load(line[:-1])
+
+        self.compact()
+
+    def _append(self, line):
+        self.log.write(line)
+        self.log.write('\n')
+
+    def compact(self):
+        with self.lock:
+            if self.log:
+                self.log.close()
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'w') as f:
+                for line in self._lines():
+                    f.write(line)
+                    f.write('\n')
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.path)
+            self.log = open(self.log_path, 'w')
+
+    def close(self):
+        self.compact()
+        self.log.close()
+
+
+# Persistent set of IDs with one ID per line.
+class IdSet(_LoggedIndex):
+
+    def __init__(self, path, convert=str):
+        self.convert = convert
+        self.ids = set()
+        _LoggedIndex.__init__(self, path)
+
+    def _load(self, line):
+        self.ids.add(self.convert(line))
+
+    def _lines(self):
+        return (str(identifier) for identifier in self.ids)
+
+    def __contains__(self, identifier):
+        return identifier in self.ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def add(self, identifier):
+        with self.lock:
+            if identifier in self.ids:
+                return
+            self.ids.add(identifier)
+            self._append(str(identifier))
+            self.log.flush()
+
+    def update(self, identifiers):
+        with self.lock:
+            for identifier in identifiers:
+                if identifier not in self.ids:
+                    self.ids.add(identifier)
+                    self._append(str(identifier))
+            self.log.flush()
+
+
+# Persistent mapping from IDs to string values without tabs or newlines, one
+# tab-separated pair per line.
+class IdMap(_LoggedIndex):
+
+    def __init__(self, path, convert=str):
+        self.convert = convert
+        self.values = {}
+        _LoggedIndex.__init__(self, path)
+
+    def _load(self, line):
+        identifier, value = line.split('\t', 1)
+        self.values[self.convert(identifier)] = value
+
+    def _lines(self):
+        return ('{}\t{}'.format(identifier, value)
+                for identifier, value in self.values.items())
+
+    def __contains__(self, identifier):
+        return identifier in self.values
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, identifier):
+        return self.values[identifier]
+
+    def __setitem__(self, identifier, value):
+        with self.lock:
+            if self.values.get(identifier) == value:
+                return
+            self.values[identifier] = value
+            self._append('{}\t{}'.format(identifier, value))
+            self.log.flush()
+
+    def update(self, pairs):
+        with self.lock:
+            for identifier, value in pairs:
+                if self.values.get(identifier) != value:
+                    self.values[identifier] = value
+                    self._append('{}\t{}'.format(identifier, value))
+            self.log.flush()
+
+    def items(self):
+        return self.values.items()
+
+
+# Persistent set of integer IDs in 1..size as a memory-mapped bitmap with one
+# bit per ID.
+class IdBitmap(object):
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        length = size // 8 + 1
+        self.created = not os.path.exists(path)
+        with open(path, 'ab') as f:
+            if f.tell() < length:
+                f.truncate(length)
+        self.file = open(path, 'r+b')
+        self.bits = mmap.mmap(self.file.fileno(), length)
+        self.lock = threading.Lock()
+
+    def __contains__(self, identifier):
+        return bool(self.bits[identifier >> 3] & (1 << (identifier & 7)))
+
+    def add(self, identifier):
+        if not 0 < identifier <= self.size:
+            raise ValueError('ID {} out of range'.format(identifier))
+        with self.lock:
+            self.bits[identifier >> 3] |= 1 << (identifier & 7)
+
+    def update(self, identifiers):
+        for identifier in identifiers:
+            self.add(identifier)
+
+    def flush(self):
+        self.bits.flush()
+
+    def close(self):
+        self.bits.flush()
+        self.bits.close()
+        self.file.close()
@@ -0,0 +1,183 @@
+import bisect
+import http.server
+import os
+import threading
+import time
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace(
+        '\n', r'\n')
+
+
+def _format_labels(pairs):
+    pairs = list(pairs)
+    if not pairs:
+        return ''
+    return '{{{}}}'.format(','.join('{}="{}"'.format(name, _escape(value))
+                                    for name, value in pairs))
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# Base of the metric types. Values are kept per combination of label values,
+# which are passed as keyword arguments.
+class _Metric(object):
+
+    TYPE = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError('{} has the labels {}, got {}'.format(
+                self.name, self.labels, sorted(labels)))
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def _samples(self, key, value):
+        yield self.name, zip(self.labels, key), value
+
+    def exposition(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help),
+                 '# TYPE {} {}'.format(self.name, self.TYPE)]
+        with self.lock:
+            values = sorted(self.values.items())
+        for key, value in values:
+            for name, labels, sample in self._samples(key, value):
+                lines.append('{}{} {}'.format(name, _format_labels(labels),
+                                              _format_value(sample)))
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+
+    TYPE = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+
+    TYPE = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+# Counts observations in cumulative buckets given by their upper bounds.
+class Histogram(_Metric):
+
+    TYPE = 'histogram'
+
+    def __init__(self, name, help, labels=(),
+                 buckets=(.01, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)):
+        _Metric.__init__(self, name, help, labels)
+        self.buckets = sorted(buckets) + [float('inf')]
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            if key not in self.values:
+                # (counts per bucket, sum)
+                self.values[key] = ([0] * len(self.buckets), 0.)
+            counts, total = self.values[key]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.values[key] = (counts, total + value)
+
+    def _samples(self, key, value):
+        counts, total = value
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            yield (self.name + '_bucket',
+                   list(zip(self.labels, key)) + [('le', _format_value(
+                       bound))],
+                   cumulative)
+        yield self.name + '_sum', zip(self.labels, key), total
+        yield self.name + '_count', zip(self.labels, key), cumulative
+
+
+# Set of metrics which can be exposed in the Prometheus text format over
+# HTTP and dumped to a file.
+class Registry(object):
+
+    def __init__(self):
+        self.metrics = []
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self._add(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self._add(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), **kwargs):
+        return self._add(Histogram(name, help, labels, **kwargs))
+
+    def exposition(self):
+        return ''.join(metric.exposition() + '\n' for metric in self.metrics)
+
+    # serves the metrics on every path from a daemon thread
+    def serve(self, port, host='127.0.0.1'):
+        registry = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                body = registry.exposition().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    def dump(self, path):
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as f:
+            f.write(self.exposition())
+        os.replace(temp_path, path)
+
+    # dumps the metrics to path every interval seconds from a daemon thread
+    def dump_periodically(self, path, interval=60):
+
+        def run():
+            while True:
+                time.sleep(interval)
+                self.dump(path)
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
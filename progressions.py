@@ -1,37 +1,46 @@
+import asyncio
+import concurrent.futures
 import glob
+import heapq
+import itertools
 import os
 import os.path
-import random
 import requests
-import threading
 import time
 
+import fetching
+import idindex
+import metrics
+import snapshots
+
 out_dir = os.path.expanduser('~/500px-progressions')
 try:
     os.mkdir(out_dir)
 except OSError:
     pass
 
-fresh_url = 'https://webapi.500px.com/discovery/fresh?feature=fresh&include_states=true&include_licensing=false&page=1&rpp=1'
+fresh_url = 'https://webapi.500px.com/discovery/fresh?feature=fresh&include_states=true&include_licensing=false&page=1&rpp={}'
 
-# IDs of photos that already have been processed or are currently processing
-processed_photos = [int(os.path.basename(d).split('-')[0])
-                    for d in glob.glob(os.path.join(out_dir, '*'))]
-processed_photos = set(processed_photos)
+# snapshots of all photos are appended to the segments of this store
+store = snapshots.SnapshotStore(os.path.join(out_dir, 'segments'),
+                                shards=256, sync_every=200)
 
+# IDs of photos that already have been processed or are currently processing.
+# The store and the directories and archives of former runs are only scanned
+# once to create the index.
+processed_photos = idindex.IdSet(os.path.join(out_dir, 'photos.ids'), int)
+if processed_photos.created:
+    processed_photos.update(
+        int(os.path.basename(d).split('-')[0])
+        for d in glob.glob(os.path.join(out_dir, '*'))
+        if os.path.basename(d).split('-')[0].isdigit())
+    processed_photos.update(store.photo_ids())
 
-def get_new_photo():
-    while True:
-        response = requests.get(fresh_url)
-        if response.status_code != requests.codes.ok:
-            raise RuntimeError("Unable to get a new photo")
-        photo_id = int(response.json()['photos'][0]['id'])
-        user_id = response.json()['photos'][0]['user']['username']
-        if photo_id not in processed_photos:
-            processed_photos.add(photo_id)
-            return (photo_id, user_id)
-        else:
-            time.sleep(2)
+# number of photo/user fetches running at the same time
+max_concurrent_fetches = 50
+
+# keep-alive connections shared by all fetches
+session = fetching.create_session(max_concurrent_fetches)
 
 
 # (interval time, number of iterations)
@@ -41,123 +50,379 @@ schedule = [
     (60 * 60, 24),  # every hour for another days
 ]
 
+# number of photos that are tracked at the same time
+max_tracked_photos = 20000
+# photos requested per poll of the fresh feed
+discovery_page_size = 100
+# bounds in seconds for the adaptive interval between two polls
+discovery_interval = (5, 300)
+# discovered photos waiting for a free tracking slot
+discovery_queue_size = 1000
+# seconds between two discovery reports
+discovery_report_interval = 600
+# more errors than this for a photo stop tracking it
+max_errors = 3
+
+# local port of the Prometheus endpoint
+metrics_port = 9108
+# the metrics are also written to this file every metrics_dump_interval
+# seconds
+metrics_path = os.path.join(out_dir, 'metrics.prom')
+metrics_dump_interval = 60
+
+registry = metrics.Registry()
+fetch_latency = registry.histogram(
+    'progressions_fetch_seconds', 'Duration of fetches per endpoint',
+    ['endpoint'])
+schedule_slippage = registry.histogram(
+    'progressions_schedule_slippage_seconds',
+    'Start of a photo fetch minus its planned time',
+    buckets=(.1, .5, 1, 5, 10, 30, 60, 120, 300, 600, 1800))
+slot_wait = registry.histogram(
+    'progressions_slot_wait_seconds',
+    'Time due photos waited for a free fetch slot',
+    buckets=(.01, .1, .5, 1, 5, 10, 30, 60, 300))
+fetch_errors = registry.counter(
+    'progressions_fetch_errors_total',
+    'Failed fetches per endpoint and status code or exception',
+    ['endpoint', 'status'])
+bytes_written = registry.counter(
+    'progressions_bytes_written_total',
+    'Uncompressed bytes of pages written to the store', ['page'])
+fetch_slots = registry.gauge(
+    'progressions_fetch_slots', 'Photo fetches allowed at the same time')
+in_flight = registry.gauge(
+    'progressions_fetches_in_flight', 'Photo fetches running')
+tracked_photos = registry.gauge(
+    'progressions_tracked_photos', 'Photos being tracked')
+scheduled_photos = registry.gauge(
+    'progressions_scheduled_photos', 'Photos waiting for their next fetch')
+
+
+def _log(message):
+    print('{}: {}'.format(int(time.time()), message))
+
+
+# Polls the fresh feed in large pages and hands photos not seen before to the
+# scheduler through a bounded queue. The poll interval grows while pages
+# mostly contain known photos and shrinks when whole pages are new.
+class Discovery(object):
+
+    def __init__(self, page_size=discovery_page_size,
+                 queue_size=discovery_queue_size):
+        self.page_size = page_size
+        self.queue = asyncio.Queue(queue_size)
+        self.interval = discovery_interval[0]
+        self.polled = 0
+        self.discovered = 0
+        self.started = time.time()
+        self.last_report = self.started
 
-class Worker(object):
+    def _log(self, message):
+        _log('Discovery: {}'.format(message))
+
+    def fetch(self):
+        started = time.time()
+        try:
+            response = session.get(fresh_url.format(self.page_size))
+        except requests.exceptions.RequestException as e:
+            fetch_errors.inc(endpoint='fresh', status=type(e).__name__)
+            raise
+        finally:
+            fetch_latency.observe(time.time() - started, endpoint='fresh')
+        if response.status_code != requests.codes.ok:
+            fetch_errors.inc(endpoint='fresh', status=response.status_code)
+            raise RuntimeError("Unable to get new photos: {}".format(
+                response.status_code))
+
+        photos = response.json()['photos']
+        new_photos = []
+        for photo in photos:
+            try:
+                photo_id = int(photo['id'])
+                username = photo['user']['username']
+            except (KeyError, TypeError, ValueError):
+                # incomplete entries are skipped, not the whole page
+                continue
+            if photo_id not in processed_photos:
+                processed_photos.add(photo_id)
+                new_photos.append((photo_id, username))
+        return len(photos), new_photos
+
+    def _adapt(self, polled, new):
+        if polled and new == polled:
+            # everything was new, photos might have been missed in between
+            self.interval = max(discovery_interval[0], self.interval / 2)
+        elif new <= polled * 0.1:
+            self.interval = min(discovery_interval[1], self.interval * 1.5)
+
+    def duplicate_ratio(self):
+        if not self.polled:
+            return 0.
+        return 1. - self.discovered / self.polled
+
+    def rate(self):
+        return self.discovered / max(1., time.time() - self.started) * 60
+
+    def report(self):
+        self._log("{} photos discovered ({:.2f}/min), "
+                  "duplicate ratio {:.2f}, interval {:.0f}s, "
+                  "{} waiting".format(self.discovered,
+                                      self.rate(),
+                                      self.duplicate_ratio(),
+                                      self.interval,
+                                      self.queue.qsize()))
+
+    async def run(self, executor):
+        loop = asyncio.get_event_loop()
+        while True:
+            try:
+                polled, new_photos = await loop.run_in_executor(executor,
+                                                                self.fetch)
+            except Exception as e:
+                # also unexpected responses, e.g. without photos or users
+                self._log("Error polling the fresh feed: {!r}".format(e))
+                self.interval = min(discovery_interval[1], self.interval * 2)
+            else:
+                self.polled += polled
+                self.discovered += len(new_photos)
+                self._adapt(polled, len(new_photos))
+                for photo in new_photos:
+                    await self.queue.put(photo)
+
+            if time.time() - self.last_report >= discovery_report_interval:
+                self.last_report = time.time()
+                self.report()
+
+            await asyncio.sleep(self.interval)
 
-    def __init__(self, worker_id, schedule, continue_event):
-        self.worker_id = worker_id
+
+class Tracker(object):
+
+    def __init__(self, photo_id, user_id, schedule):
+        self.photo_id = photo_id
+        self.user_id = user_id
         self.schedule = schedule
-        self.continue_event = continue_event
+        self.errors = []
+        # ETag and Last-Modified of the last stored page per kind
+        self.validators = {'photo': None, 'user': None}
+        # planned time of the next fetch
+        self.timer = time.time()
+        # position inside the schedule: (entry, iteration within entry)
+        self.stage = 0
+        self.iteration = 0
 
     def _log(self, message):
-        print('{}: Worker {}: {}'.format(int(time.time()),
-                                         self.worker_id,
-                                         message))
-
-    def __call__(self):
-
-        while not self.continue_event.is_set():
-            errors = []
-            photo_id, user_id = get_new_photo()
-            self._log("Starting to process photo {}".format(photo_id))
-
-            photo_dir = os.path.join(out_dir, str(photo_id))
-            os.mkdir(photo_dir)
-
-            timer = time.time()
-            for sleep_time, iterations in self.schedule:
-                self._log("Starting schedule {} for image {}".format(
-                    (sleep_time, iterations), photo_id))
-                if self.continue_event.is_set():
-                    self._log("Stopping as requested")
-                    return
-
-                for _ in range(iterations):
-                    if self.continue_event.is_set():
-                        self._log("Stopping as requested")
-                        return
-                    self._log("New loop for {} at {}".format(
-                        photo_id, timer))
+        _log('Photo {}: {}'.format(self.photo_id, message))
 
-                    try:
-                        photo_response = requests.get(
-                            'https://500px.com/photo/' + str(photo_id))
-                        user_response = requests.get(
-                            'https://500px.com/' + str(user_id))
-
-                        timestamp_dir = os.path.join(
-                            photo_dir, str(int(timer)))
-                        os.mkdir(timestamp_dir)
-
-                        if photo_response.status_code != requests.codes.ok or \
-                                user_response.status_code != requests.codes.ok:
-                            self._log("Error getting data. "
-                                      "photo_response: {}, "
-                                      "user_response: {}".format(
-                                          photo_response, user_response))
-                            errors.append((int(timer),
-                                           photo_response.status_code,
-                                           user_response.status_code))
-                        else:
-
-                            with open(os.path.join(timestamp_dir,
-                                                   'photo.html'), 'w') as f:
-                                f.write(photo_response.text)
-                            with open(os.path.join(timestamp_dir,
-                                                   'user.html'), 'w') as f:
-                                f.write(user_response.text)
-                    except requests.exceptions.RequestException as e:
-                        errors.append((int(timer), e, e))
-
-                    if len(errors) > 3:
-                        self._log("Too many errors, skipping to next photo")
-                        break
-
-                    timer += sleep_time
-                    self.continue_event.wait(max(0, timer - time.time()))
-
-                if len(errors) > 3:
-                    self._log("Too many errors, skipping to next photo")
-                    break
-
-            self._log("Photo {} finished".format(photo_id))
-
-            if errors:
-                with open(os.path.join(photo_dir, 'error'), 'w') as f:
-                    for timestamp, photo_status, user_status in errors:
-                        f.write('{}: {}, {}\n'.format(timestamp,
-                                                      photo_status,
-                                                      user_status))
+    def start(self):
+        self._log("Starting to process photo")
+
+    def _store(self, kind, response):
+        if fetching.is_unchanged(response):
+            # page is identical to the last stored one, only mark the snapshot
+            store.put_unchanged(self.photo_id, self.timer, kind)
+        else:
+            contents = response.text.encode('utf-8')
+            store.put_page(self.photo_id, self.timer, kind, contents)
+            bytes_written.inc(len(contents), page=kind)
+            self.validators[kind] = fetching.get_validators(response)
+
+    def _get(self, kind, url):
+        started = time.time()
+        try:
+            response = fetching.conditional_get(session, url,
+                                                self.validators[kind])
+        except requests.exceptions.RequestException as e:
+            fetch_errors.inc(endpoint=kind, status=type(e).__name__)
+            raise
+        finally:
+            fetch_latency.observe(time.time() - started, endpoint=kind)
+        if not fetching.is_current(response):
+            fetch_errors.inc(endpoint=kind, status=response.status_code)
+        return response
+
+    def fetch(self):
+        self._log("New loop at {}".format(self.timer))
+        schedule_slippage.observe(time.time() - self.timer)
+
+        try:
+            photo_response = self._get(
+                'photo', 'https://500px.com/photo/' + str(self.photo_id))
+            user_response = self._get(
+                'user', 'https://500px.com/' + str(self.user_id))
+
+            if not fetching.is_current(photo_response) or \
+                    not fetching.is_current(user_response):
+                self._log("Error getting data. "
+                          "photo_response: {}, "
+                          "user_response: {}".format(
+                              photo_response, user_response))
+                self.errors.append((int(self.timer),
+                                    photo_response.status_code,
+                                    user_response.status_code))
             else:
-                with open(os.path.join(photo_dir, 'ok'), 'w') as f:
-                    f.write('OK')
+                self._store('photo', photo_response)
+                self._store('user', user_response)
+        except requests.exceptions.RequestException as e:
+            self.errors.append((int(self.timer), e, e))
+
+    # moves the planned time to the next fetch, returns False if the schedule
+    # is exhausted or the photo has too many errors
+    def advance(self):
+        if len(self.errors) > max_errors:
+            self._log("Too many errors, skipping to next photo")
+            return False
+
+        sleep_time, iterations = self.schedule[self.stage]
+        self.timer += sleep_time
+        self.iteration += 1
+        if self.iteration >= iterations:
+            self.stage += 1
+            self.iteration = 0
+            if self.stage >= len(self.schedule):
+                return False
+            self._log("Starting schedule {}".format(
+                self.schedule[self.stage]))
+        return True
+
+    def finish(self):
+        self._log("Photo finished")
+
+        if self.errors:
+            store.put_status(self.photo_id, 'error', ''.join(
+                '{}: {}, {}\n'.format(timestamp, photo_status, user_status)
+                for timestamp, photo_status, user_status
+                in self.errors).encode('utf-8'))
+        else:
+            store.put_status(self.photo_id, 'ok', b'OK')
+
+        self._log("Writing data finished")
+
+
+# Tracks all photos from a single event loop. The next due fetch of every
+# photo is kept in a heap keyed by its planned time and the blocking fetches
+# are run in a bounded thread pool.
+class Scheduler(object):
 
-            self._log("Writing data finished")
+    def __init__(self, schedule, discovery,
+                 max_concurrent=max_concurrent_fetches,
+                 max_tracked=max_tracked_photos):
+        self.schedule = schedule
+        self.discovery = discovery
+        self.max_concurrent = max_concurrent
+        self.max_tracked = max_tracked
+        # entries: (due time, sequence number, tracker)
+        self.queue = []
+        self.sequence = itertools.count()
+        self.tracked = None
+        self.wakeup = None
+        self.executor = None
+
+    def _push(self, tracker):
+        heapq.heappush(self.queue,
+                       (tracker.timer, next(self.sequence), tracker))
+        scheduled_photos.set(len(self.queue))
+        self.wakeup.set()
+
+    async def _intake(self):
+        while True:
+            await self.tracked.acquire()
+            photo_id, user_id = await self.discovery.queue.get()
+            tracker = Tracker(photo_id, user_id, self.schedule)
+            tracker.start()
+            tracked_photos.inc()
+            self._push(tracker)
+
+    async def _process(self, tracker, slots):
+        loop = asyncio.get_event_loop()
+        try:
+            in_flight.inc()
+            try:
+                await loop.run_in_executor(self.executor, tracker.fetch)
+            except Exception as e:
+                tracker._log("Unexpected error: {}".format(e))
+                tracker.errors.append((int(tracker.timer), e, e))
+            finally:
+                in_flight.dec()
+            if tracker.advance():
+                self._push(tracker)
+            else:
+                try:
+                    await loop.run_in_executor(self.executor, tracker.finish)
+                except Exception as e:
+                    tracker._log("Error while finishing: {!r}".format(e))
+                finally:
+                    tracked_photos.dec()
+                    self.tracked.release()
+        finally:
+            slots.release()
+
+    async def run(self):
+        self.wakeup = asyncio.Event()
+        self.tracked = asyncio.Semaphore(self.max_tracked)
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.max_concurrent + 2)
+        slots = asyncio.Semaphore(self.max_concurrent)
+        fetch_slots.set(self.max_concurrent)
+        pending = set()
+        producers = [asyncio.ensure_future(self.discovery.run(self.executor)),
+                     asyncio.ensure_future(self._intake())]
+        for producer in producers:
+            producer.add_done_callback(lambda _: self.wakeup.set())
+        try:
+            while True:
+                for producer in producers:
+                    if producer.done():
+                        # propagate unexpected errors
+                        producer.result()
+
+                self.wakeup.clear()
+                if not self.queue:
+                    await self.wakeup.wait()
+                    continue
+
+                delay = self.queue[0][0] - time.time()
+                if delay > 0:
+                    # a new photo might be due earlier than the current head
+                    try:
+                        await asyncio.wait_for(self.wakeup.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+                waiting = time.time()
+                await slots.acquire()
+                slot_wait.observe(time.time() - waiting)
+                _, _, tracker = heapq.heappop(self.queue)
+                scheduled_photos.set(len(self.queue))
+                task = asyncio.ensure_future(self._process(tracker, slots))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+        finally:
+            for producer in producers:
+                producer.cancel()
+            for task in pending:
+                task.cancel()
+            self.executor.shutdown(wait=True)
 
 
 if __name__ == "__main__":
 
-    continue_event = threading.Event()
+    async def main():
+        scheduler = Scheduler(schedule, Discovery())
+        registry.serve(metrics_port)
+        registry.dump_periodically(metrics_path, metrics_dump_interval)
+        try:
+            await scheduler.run()
+        finally:
+            scheduler.discovery.report()
+            registry.dump(metrics_path)
+            store.close()
+            processed_photos.close()
 
-    threads = []
     try:
-        print("starting to spawn workers")
-        # for worker_id in range(1):
-        for worker_id in range(200):
-            worker = Worker(worker_id, schedule, continue_event)
-            thread = threading.Thread(target=worker,
-                                      name='worker-{}'.format(worker_id))
-            threads.append((thread, worker))
-            thread.start()
-            time.sleep(10 + random.randint(0, 40))
-
-        print("Spawning finished, starting main loop")
-
-        while True:
-            time.sleep(100)
+        print("Starting scheduler")
+        asyncio.run(main())
     except KeyboardInterrupt:
         print("Interrupt received")
-        continue_event.set()
-        for thread, worker in threads:
-            print("Joining worker {}".format(worker.worker_id))
-            thread.join()
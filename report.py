@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+
+import argparse
+import functools
+import json
+import multiprocessing
+import os
+import os.path
+import sys
+import time
+import traceback
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+
+import analysis
+import tablecache
+
+
+REPORT_DIR = os.path.join(analysis.DATA_DIR, 'report')
+# state of the rendered plots in the report directory
+STATE = 'report.json'
+# increase when the rendering of the plots changes
+REPORT_VERSION = 1
+
+# (name, function of analysis, input, keyword arguments) for every plot of
+# the report. Inputs are 'aggregated' (the aggregated frame), 'frame' (the
+# consolidated progressions) or 'features' (aggregated frame and feature
+# table).
+PLOTS = [
+    # description of the data set
+    ('uploaded-per-hour', 'uploaded_time_histogram', 'aggregated',
+     {'title': 'contained photos uploaded per hour of day (UTC)'}),
+    ('photos-per-gender', 'categorial_distribution', 'aggregated',
+     {'item': 'last-json-user-sex', 'replace_map': analysis.GENDER_MAP,
+      'title': 'contained photos per gender', 'rotate_xticks': True}),
+    ('photos-per-category', 'categorial_distribution', 'aggregated',
+     {'item': 'last-meta-category',
+      'title': 'contained photos per category', 'rotate_xticks': True}),
+    ('highest-rating-distribution', 'numerical_distribution', 'aggregated',
+     {'item': 'last-json-highest_rating',
+      'title': 'distribution of highest ratings after 2 days'}),
+    ('tags-distribution', 'numerical_distribution', 'aggregated',
+     {'item': 'last-meta-tags-count',
+      'title': 'distribution of the number of tags per photo'}),
+    ('distance-to-upload', 'distance_to_upload_date', 'aggregated',
+     {'title': 'time delta between upload date and first scraping',
+      'xlabel': 'seconds'}),
+
+    # comparison per category
+    ('highest-rating-per-category', 'item_per_category', 'aggregated',
+     {'item': 'last-json-highest_rating',
+      'title': 'mean highest rating after 2 days per category'}),
+    ('tags-per-category', 'item_per_category', 'aggregated',
+     {'item': 'last-meta-tags-count',
+      'title': 'mean number of tags per category'}),
+
+    # numerical relations
+    ('affection-highest-rating', 'aggregated_scatter', 'aggregated',
+     {'x': 'first-json-user-affection', 'y': 'last-json-highest_rating',
+      'xlabel': 'user affection at upload',
+      'ylabel': 'highest rating after two days',
+      'title': 'relation of user affection and highest rating'}),
+    ('followers-highest-rating', 'aggregated_scatter', 'aggregated',
+     {'x': 'first-json-user-followers_count',
+      'y': 'last-json-highest_rating',
+      'xlabel': 'followers at upload',
+      'ylabel': 'highest rating after two days',
+      'title': 'relation of and follower count and highest rating'}),
+    ('followers-affection', 'aggregated_scatter', 'aggregated',
+     {'x': 'first-json-user-followers_count',
+      'y': 'first-json-user-affection',
+      'xlabel': 'followers', 'ylabel': 'affection',
+      'title': 'relation of followers and affection'}),
+
+    # understand rating
+    ('views-rating', 'aggregated_scatter', 'aggregated',
+     {'x': 'last-json-times_viewed', 'y': 'last-json-rating',
+      'xlabel': 'times viewed', 'ylabel': 'rating',
+      'title': 'relation of view count and rating'}),
+    ('votes-rating', 'aggregated_scatter', 'aggregated',
+     {'x': 'last-json-votes_count', 'y': 'last-json-rating',
+      'xlabel': 'votes', 'ylabel': 'rating',
+      'title': 'relation of vote count and rating'}),
+    ('comments-rating', 'aggregated_scatter', 'aggregated',
+     {'x': 'last-json-comments_count', 'y': 'last-json-rating',
+      'xlabel': 'comments', 'ylabel': 'rating',
+      'title': 'relation of comments count and rating'}),
+
+    # temporal analysis
+    ('followers-difference', 'difference_of_followers', 'frame',
+     {'title': 'highest rating and change in number of followers'}),
+    ('rating-progression', 'all_series_progression', 'frame',
+     {'density': True, 'title': 'evolution of rating'}),
+
+    # features
+    ('feature-importances', 'feature_importances', 'features',
+     {'title': 'feature importances for the highest rating',
+      'rotate_xticks': True}),
+]
+
+
+# inputs of the plots, loaded once per worker process when first needed.
+# build_report derives them before starting the workers, which are daemonic
+# and derive missing ones without a pool of their own.
+_files = None
+_inputs = {}
+
+
+def _init_worker(files):
+    global _files
+    _files = files
+    _inputs.clear()
+
+
+def _input(source):
+    if source not in _inputs:
+        if source == 'aggregated':
+            _inputs[source] = (analysis.cached_aggregate(_files,
+                                                         processes=1),)
+        elif source == 'frame':
+            _inputs[source] = (analysis.load_frame(_files, processes=1),)
+        else:
+            _inputs[source] = (_input('aggregated')[0],
+                               analysis.cached_features(_files,
+                                                        processes=1))
+    return _inputs[source]
+
+
+# Renders a plot to a file per format and returns (name, files, error,
+# seconds), so that a failing plot does not stop the report.
+def render(plot, out_dir, formats):
+    name, function, source, kwargs = plot
+    started = time.time()
+    outputs = []
+    try:
+        fig = getattr(analysis, function)(*_input(source), **kwargs)
+        try:
+            for image_format in formats:
+                path = os.path.join(out_dir,
+                                    '{}.{}'.format(name, image_format))
+                temp_path = path + '.tmp'
+                fig.savefig(temp_path, format=image_format,
+                            bbox_inches='tight')
+                os.replace(temp_path, path)
+                outputs.append(os.path.basename(path))
+        finally:
+            plt.close(fig)
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+    return name, outputs, error, time.time() - started
+
+
+# fingerprint per plot of the input files, the versions of the derived
+# tables and the arguments of the plot
+def fingerprints(files, formats):
+    inputs = tablecache.fingerprint(files, REPORT_VERSION,
+                                    analysis.CONSOLIDATE_VERSION,
+                                    analysis.AGGREGATE_VERSION,
+                                    analysis.FEATURES_VERSION)
+    return {name: tablecache.fingerprint([], inputs, function, source,
+                                         sorted(kwargs.items()),
+                                         list(formats))
+            for name, function, source, kwargs in PLOTS}
+
+
+def write_index(out_dir, state):
+    entries = []
+    for name, _, _, kwargs in PLOTS:
+        title = kwargs.get('title', name)
+        if name not in state:
+            entries.append('<h2>{}</h2>\n<p>not rendered</p>'.format(title))
+            continue
+        outputs = state[name]['outputs']
+        links = ' '.join('<a href="{0}">{0}</a>'.format(output)
+                         for output in outputs)
+        entries.append('<h2>{}</h2>\n<img src="{}" alt="{}"/>\n'
+                       '<p>{}</p>'.format(title, outputs[0], name, links))
+
+    path = os.path.join(out_dir, 'index.html')
+    with open(path + '.tmp', 'w') as f:
+        f.write('<!DOCTYPE html>\n<html>\n<head><meta charset="utf-8"/>'
+                '<title>500px progressions</title></head>\n<body>\n'
+                '{}\n</body>\n</html>\n'.format('\n'.join(entries)))
+    os.replace(path + '.tmp', path)
+
+
+# Renders all plots whose fingerprint changed or whose files are missing
+# with a pool of processes and writes an index page. Returns the names of
+# the failed plots.
+def build_report(files=None, out_dir=REPORT_DIR, formats=('png', 'svg'),
+                 processes=None, force=False):
+    files = analysis.get_files() if files is None else files
+    try:
+        os.makedirs(out_dir)
+    except FileExistsError:
+        pass
+
+    state_path = os.path.join(out_dir, STATE)
+    state = {}
+    if os.path.exists(state_path):
+        with open(state_path) as f:
+            state = json.load(f)
+
+    current = fingerprints(files, formats)
+    stale = [plot for plot in PLOTS
+             if force or plot[0] not in state or
+             state[plot[0]]['fingerprint'] != current[plot[0]] or
+             not all(os.path.exists(os.path.join(out_dir, output))
+                     for output in state[plot[0]]['outputs'])]
+    print('{} of {} plots up to date'.format(len(PLOTS) - len(stale),
+                                             len(PLOTS)))
+
+    failed = []
+    if stale:
+        # derive the shared tables once before the workers read them
+        sources = set(plot[2] for plot in stale)
+        if sources & {'aggregated', 'features'}:
+            analysis.cached_aggregate(files)
+        if 'features' in sources:
+            analysis.cached_features(files)
+        if 'frame' in sources and analysis.consolidated_fingerprint() != \
+                analysis.consolidated_key(files):
+            analysis.load_frame(files, rebuild=True)
+
+        started = time.time()
+        with multiprocessing.Pool(processes, initializer=_init_worker,
+                                  initargs=(files,)) as pool:
+            results = pool.imap_unordered(
+                functools.partial(render, out_dir=out_dir, formats=formats),
+                stale)
+            for done, (name, outputs, error, seconds) in enumerate(results,
+                                                                    1):
+                if error:
+                    failed.append(name)
+                    state.pop(name, None)
+                    print('[{}/{}] {} failed after {:.1f}s:\n{}'.format(
+                        done, len(stale), name, seconds, error))
+                else:
+                    state[name] = {'fingerprint': current[name],
+                                   'outputs': outputs}
+                    print('[{}/{}] {} rendered in {:.1f}s'.format(
+                        done, len(stale), name, seconds))
+        print('{} plots in {:.1f}s, {} failed'.format(
+            len(stale), time.time() - started, len(failed)))
+
+    write_index(out_dir, state)
+    with open(state_path + '.tmp', 'w') as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(state_path + '.tmp', state_path)
+    return failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Renders the plots of analysis.py to a report directory')
+    parser.add_argument('files', nargs='*', metavar='FILE',
+                        help='progressions (default: all in the data '
+                             'directory)')
+    parser.add_argument('-o', '--out', default=REPORT_DIR,
+                        help='report directory (default: %(default)s)')
+    parser.add_argument('-j', '--processes', type=int, default=None,
+                        help='number of worker processes (default: CPUs)')
+    parser.add_argument('--formats', default='png,svg',
+                        help='image formats (default: %(default)s)')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='render up-to-date plots again')
+    args = parser.parse_args(argv)
+
+    failed = build_report(args.files or None, args.out,
+                          tuple(args.formats.split(',')), args.processes,
+                          args.force)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,96 @@
+import hashlib
+import os
+import os.path
+import random
+import struct
+
+
+# Pseudo-random permutation of range(size) from a balanced Feistel network
+# over the smallest even number of bits covering size. Results outside of the
+# range are fed through the network again (cycle walking) until they fit.
+class Permutation(object):
+
+    def __init__(self, size, seed, rounds=4):
+        self.size = size
+        bits = max(2, (size - 1).bit_length())
+        bits += bits % 2
+        self.half_bits = bits // 2
+        self.mask = (1 << self.half_bits) - 1
+        self.keys = [hashlib.blake2b(struct.pack('<QQ', seed, i),
+                                     digest_size=8).digest()
+                     for i in range(rounds)]
+
+    def _round(self, value, key):
+        digest = hashlib.blake2b(value.to_bytes(8, 'little'), key=key,
+                                 digest_size=8).digest()
+        return int.from_bytes(digest, 'little') & self.mask
+
+    def __call__(self, index):
+        if not 0 <= index < self.size:
+            raise IndexError('index {} out of range'.format(index))
+        value = index
+        while True:
+            left = value >> self.half_bits
+            right = value & self.mask
+            for key in self.keys:
+                left, right = right, left ^ self._round(right, key)
+            value = (left << self.half_bits) | right
+            if value < self.size:
+                return value
+
+
+# Iterates the IDs low..high exactly once in the order of a seeded
+# permutation. Drawn IDs are outstanding until they are passed to done().
+# The seed and the cursor of the oldest outstanding draw are persisted in a
+# small state file that is updated in place, so a new instance continues
+# with the first ID that was not done when the last one stopped. IDs drawn
+# after it are drawn again, also if they were done.
+class PermutationSampler(object):
+
+    STATE = struct.Struct('<QQ')
+
+    def __init__(self, path, low, high, seed=None):
+        self.low = low
+        self.size = high - low + 1
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+
+        state = os.pread(self.fd, self.STATE.size, 0)
+        if len(state) == self.STATE.size:
+            seed, cursor = self.STATE.unpack(state)
+        else:
+            if seed is None:
+                seed = random.SystemRandom().getrandbits(63)
+            cursor = 0
+        self.seed = seed
+        self.cursor = cursor
+        # cursor per outstanding ID
+        self.outstanding = {}
+        self.permutation = Permutation(self.size, seed)
+        self._persist()
+
+    def _persist(self):
+        low_water = min(self.outstanding.values(), default=self.cursor)
+        os.pwrite(self.fd, self.STATE.pack(self.seed, low_water), 0)
+
+    def __len__(self):
+        return self.size - self.cursor
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.cursor >= self.size:
+            raise StopIteration
+        value = self.low + self.permutation(self.cursor)
+        self.outstanding[value] = self.cursor
+        self.cursor += 1
+        self._persist()
+        return value
+
+    def done(self, value):
+        del self.outstanding[value]
+        self._persist()
+
+    def close(self):
+        os.fsync(self.fd)
+        os.close(self.fd)
@@ -1,9 +1,17 @@
+import asyncio
+import concurrent.futures
 import glob
+import multiprocessing
 import os
 import os.path
-import random
 import requests
-from lxml import etree
+import time
+
+import authors
+import fetching
+import idindex
+import sampling
+import segments
 
 out_dir = '/home/languitar/500px-dataset'
 image_dir = os.path.join(out_dir, 'images')
@@ -14,92 +22,324 @@ user_success_dir = os.path.join(user_dir, 'success')
 user_failure_dir = os.path.join(user_dir, 'failure')
 
 try:
-    os.makedirs(image_success_dir)
-except FileExistsError:
-    pass
-try:
-    os.makedirs(image_failure_dir)
-except FileExistsError:
-    pass
-try:
-    os.makedirs(user_success_dir)
+    os.makedirs(image_dir)
 except FileExistsError:
     pass
 try:
-    os.makedirs(user_failure_dir)
+    os.makedirs(user_dir)
 except FileExistsError:
     pass
 
-# find the image IDs we have already scraped
-processed_images = [int(os.path.basename(f))
-                    for f in glob.glob(os.path.join(image_success_dir, '*'))]
-processed_images += [int(os.path.basename(f))
-                     for f in glob.glob(os.path.join(image_failure_dir, '*'))]
-processed_images = set(processed_images)
+max_image_id = 221072303
+
+# number of image pages fetched at the same time
+max_concurrent_images = 20
+# number of user pages fetched at the same time
+max_concurrent_users = 10
+# user pages waiting to be fetched
+user_queue_size = 100
+# seconds between two throughput reports
+report_interval = 60
+
+# Successfully downloaded pages are packed into compressed shards keyed by
+# image ID or username, failures are kept as status rows.
+image_pages = segments.SegmentStore(os.path.join(image_dir, 'pages'),
+                                    shards=256, sync_every=500)
+image_failures = idindex.IdMap(os.path.join(image_dir, 'failures'), int)
+user_pages = segments.SegmentStore(os.path.join(user_dir, 'pages'),
+                                   shards=64, sync_every=500)
+user_failures = idindex.IdMap(os.path.join(user_dir, 'failures'))
+
 
-# find the user IDs we have already scraped
-processed_users = [os.path.basename(f)
-                   for f in glob.glob(os.path.join(user_success_dir, '*'))]
-processed_users += [os.path.basename(f)
-                    for f in glob.glob(os.path.join(user_failure_dir, '*'))]
-processed_users = set(processed_users)
+# Imports the one-file-per-page directories of former runs. A marker in the
+# store records the finished import, an interrupted one is continued with the
+# pages not stored yet. Returns whether the import ran.
+def import_directories(success_dir, failure_dir, pages, failures, convert):
+    marker = os.path.join(pages.directory, 'imported')
+    if os.path.exists(marker):
+        return False
+    for page_path in glob.glob(os.path.join(success_dir, '*')):
+        key = os.path.basename(page_path)
+        if key in pages:
+            continue
+        with open(page_path, 'rb') as f:
+            pages.put(key, f.read())
+    pages.sync()
+    for status_path in glob.glob(os.path.join(failure_dir, '*')):
+        with open(status_path) as f:
+            failures[convert(os.path.basename(status_path))] = \
+                f.read().strip()
+    with open(marker, 'w'):
+        pass
+    return True
 
 
-parser = etree.HTMLParser()
+images_imported = import_directories(image_success_dir, image_failure_dir,
+                                     image_pages, image_failures, int)
+users_imported = import_directories(user_success_dir, user_failure_dir,
+                                    user_pages, user_failures, str)
 
+# image and user IDs we have already scraped, the stores are only scanned
+# to create the indices or after an import
+processed_images = idindex.IdBitmap(os.path.join(out_dir, 'images.bitmap'),
+                                    max_image_id)
+if processed_images.created or images_imported:
+    processed_images.update(int(key) for key in image_pages.keys())
+    processed_images.update(image_id for image_id, _ in image_failures.items())
+    processed_images.flush()
 
-def get_user_url(contents):
-    return etree.fromstring(contents, parser=parser).xpath(
-        '//meta[@property="five_hundred_pixels:author"]')[0].attrib['content']
+# authors of downloaded images, so that image pages are only read once
+image_authors = idindex.IdMap(os.path.join(out_dir, 'image-authors'), int)
 
+processed_users = idindex.IdSet(os.path.join(out_dir, 'users.ids'))
+if processed_users.created or users_imported:
+    processed_users.update(user_pages.keys())
+    processed_users.update(username for username, _ in user_failures.items())
 
+# keep-alive connections shared by all fetches
+session = fetching.create_session(max_concurrent_images +
+                                  max_concurrent_users)
+
+
+# returns whether the user page was downloaded or None for a user that has
+# already been processed
 def download_user(url):
     username = os.path.basename(url)
     if username in processed_users:
         print('... skipping duplicate user')
-        return
+        return None
     print(username)
 
-    response = requests.get(url, allow_redirects=True)
+    response = session.get(url, allow_redirects=True)
 
     if response.status_code != requests.codes.ok:
         print("  error: {}".format(response.status_code))
-        with open(os.path.join(user_failure_dir, username), 'w') as f:
-            f.write(str(response.status_code))
+        user_failures[username] = str(response.status_code)
         processed_users.add(username)
+        return False
 
-    with open(os.path.join(user_success_dir, username), 'w') as f:
-        f.write(response.text)
+    user_pages.put(username, response.text.encode('utf-8'))
     processed_users.add(username)
+    return True
 
 
-# initialize missing users
-for image_path in glob.glob(os.path.join(image_success_dir, '*')):
-    with open(image_path) as f:
-        contents = f.read()
-    url = get_user_url(contents)
-    download_user(url)
-
-# for image_id in range(221072303, 0, -1):
-while True:
-    image_id = random.randint(1, 221072303)
-    if image_id in processed_images:
-        print('... skipping duplicate')
-        continue
+# returns the URL of the author if the image exists
+def download_image(image_id):
     print(image_id)
 
-    response = requests.get('https://500px.com/photo/{}'.format(image_id),
-                            allow_redirects=True)
+    response = session.get('https://500px.com/photo/{}'.format(image_id),
+                           allow_redirects=True)
 
     if response.status_code != requests.codes.ok:
         print("  error: {}".format(response.status_code))
-        with open(os.path.join(image_failure_dir, str(image_id)), 'w') as f:
-            f.write(str(response.status_code))
+        image_failures[image_id] = str(response.status_code)
         processed_images.add(image_id)
-        continue
+        return None
 
-    with open(os.path.join(image_success_dir, str(image_id)), 'w') as f:
-        f.write(response.text)
+    image_pages.put(str(image_id), response.text.encode('utf-8'))
     processed_images.add(image_id)
 
-    download_user(get_user_url(response.text))
+    url = authors.get_user_url(response.text)
+    if url:
+        image_authors[image_id] = url
+    return url
+
+
+# every image ID of the sampler exactly once in a seeded random order that is
+# continued across runs, the IDs have to be passed to sampler.done() once
+# they are processed
+def sampled_image_ids(sampler):
+    for image_id in sampler:
+        # only true for IDs scraped before the sampler existed or finished
+        # before the last run stopped
+        if image_id in processed_images:
+            print('... skipping duplicate')
+            sampler.done(image_id)
+            continue
+        yield image_id
+
+
+def _read_authors(task):
+    shard, keys = task
+    pages = segments.SegmentStore(image_pages.directory)
+    # pages are only decompressed up to the author in their head
+    return [(int(key), authors.find_user_url(chunks))
+            for key, chunks in pages.chunked_items(shard=shard, keys=keys)]
+
+
+# adds the authors of downloaded images missing in the index, reading the
+# shards of image pages with a pool of processes. The workers are forked, as
+# importing this module opens and compacts the indices.
+def index_authors(processes=None):
+    missing = {}
+    for key in image_pages.keys():
+        if int(key) not in image_authors:
+            missing.setdefault(image_pages.shard_of(key), set()).add(key)
+    if not missing:
+        return
+    print('Indexing authors of {} images'.format(
+        sum(len(keys) for keys in missing.values())))
+    with multiprocessing.get_context('fork').Pool(processes) as pool:
+        for pairs in pool.imap_unordered(_read_authors, missing.items()):
+            image_authors.update((image_id, url)
+                                 for image_id, url in pairs if url)
+
+
+# user URLs of all images downloaded so far that still need to be fetched
+def missing_user_urls():
+    return [url for url in set(url for _, url in image_authors.items())
+            if os.path.basename(url) not in processed_users]
+
+
+class Counters(object):
+
+    def __init__(self):
+        self.started = time.time()
+        self.images = 0
+        self.image_errors = 0
+        self.users = 0
+        self.user_errors = 0
+        self.duplicate_users = 0
+
+    def report(self):
+        elapsed = max(1., time.time() - self.started)
+        print('{}: images: {} ({} errors, {:.2f}/s), '
+              'users: {} ({} errors, {:.2f}/s, {} duplicates)'.format(
+                  int(time.time()),
+                  self.images, self.image_errors, self.images / elapsed,
+                  self.users, self.user_errors, self.users / elapsed,
+                  self.duplicate_users))
+
+
+# Two stage pipeline: images are fetched with a bounded number of requests in
+# flight and hand the URLs of their authors to a pool of user workers through
+# a bounded queue. A full queue blocks the image stage, so both stages share
+# the backpressure. Users queued or in flight are not queued again.
+class Pipeline(object):
+
+    def __init__(self,
+                 max_images=max_concurrent_images,
+                 max_users=max_concurrent_users,
+                 queue_size=user_queue_size):
+        self.max_images = max_images
+        self.max_users = max_users
+        self.queue_size = queue_size
+        self.counters = Counters()
+        self.pending_users = set()
+        self.users = None
+        self.executor = None
+        self.image_done = None
+
+    async def _enqueue_user(self, url):
+        username = os.path.basename(url)
+        if username in processed_users or username in self.pending_users:
+            self.counters.duplicate_users += 1
+            return
+        self.pending_users.add(username)
+        await self.users.put(url)
+
+    async def _user_worker(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            url = await self.users.get()
+            try:
+                downloaded = await loop.run_in_executor(self.executor,
+                                                        download_user, url)
+                if downloaded is None:
+                    self.counters.duplicate_users += 1
+                elif downloaded:
+                    self.counters.users += 1
+                else:
+                    self.counters.user_errors += 1
+            except Exception as e:
+                print("  error: {}".format(e))
+                self.counters.user_errors += 1
+            finally:
+                self.pending_users.discard(os.path.basename(url))
+                self.users.task_done()
+
+    async def _image(self, image_id, slots):
+        loop = asyncio.get_event_loop()
+        try:
+            url = await loop.run_in_executor(self.executor,
+                                             download_image, image_id)
+            if url is None:
+                self.counters.image_errors += 1
+            else:
+                self.counters.images += 1
+                await self._enqueue_user(url)
+        except Exception as e:
+            # e.g. a timeout, the image is neither stored nor recorded as a
+            # failure and stays outstanding to be fetched after a restart
+            print("  error: {}".format(e))
+            self.counters.image_errors += 1
+            return
+        finally:
+            slots.release()
+        # not reached if cancelled, so the image is fetched after a restart
+        if self.image_done is not None:
+            self.image_done(image_id)
+
+    async def _backfill(self, user_urls):
+        loop = asyncio.get_event_loop()
+        iterator = iter(user_urls)
+        sentinel = object()
+        while True:
+            url = await loop.run_in_executor(self.executor, next, iterator,
+                                             sentinel)
+            if url is sentinel:
+                return
+            await self._enqueue_user(url)
+
+    async def _report(self):
+        while True:
+            await asyncio.sleep(report_interval)
+            self.counters.report()
+
+    # image_done is called with every image ID whose fetch finished
+    async def run(self, image_ids, user_urls=(), image_done=None):
+        self.image_done = image_done
+        self.users = asyncio.Queue(self.queue_size)
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.max_images + self.max_users + 1)
+        slots = asyncio.Semaphore(self.max_images)
+        workers = [asyncio.ensure_future(self._user_worker())
+                   for _ in range(self.max_users)]
+        workers.append(asyncio.ensure_future(self._report()))
+        backfill = asyncio.ensure_future(self._backfill(user_urls))
+        images = set()
+        try:
+            for image_id in image_ids:
+                await slots.acquire()
+                task = asyncio.ensure_future(self._image(image_id, slots))
+                images.add(task)
+                task.add_done_callback(images.discard)
+            # let all started downloads finish
+            await asyncio.gather(backfill, *images)
+            await self.users.join()
+        finally:
+            for task in workers + [backfill] + list(images):
+                task.cancel()
+            self.executor.shutdown(wait=True)
+            processed_images.flush()
+            image_pages.close()
+            user_pages.close()
+            self.counters.report()
+
+
+if __name__ == "__main__":
+
+    index_authors()
+
+    pipeline = Pipeline()
+    # IDs not done when the last run stopped are drawn again
+    sampler = sampling.PermutationSampler(
+        os.path.join(out_dir, 'sampler.state'), 1, max_image_id)
+    try:
+        # users of images downloaded so far are fetched first if missing
+        asyncio.run(pipeline.run(sampled_image_ids(sampler),
+                                 missing_user_urls(), sampler.done))
+    except KeyboardInterrupt:
+        print("Interrupt received")
+    finally:
+        sampler.close()
@@ -0,0 +1,243 @@
+import os
+import os.path
+import struct
+import threading
+import time
+import zlib
+
+# in the segment file every record is its header followed by the encoded key
+# and the compressed payload: key length, payload length
+RECORD_HEADER = struct.Struct('<HI')
+# every index entry is followed by the encoded key:
+# payload offset in the segment, payload length, key length
+INDEX_ENTRY = struct.Struct('<QIH')
+
+
+# Append-only key/value store of compressed records. Records are distributed
+# over a fixed number of shards; every shard is a segment file holding the
+# records and an index file with their offsets. Writes are made durable in
+# batches of sync_every records or after sync_interval seconds.
+class SegmentStore(object):
+
+    def __init__(self, directory, shards=64, sync_every=100,
+                 sync_interval=60, level=6):
+        self.directory = directory
+        self.shards = shards
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.level = level
+        try:
+            os.makedirs(directory)
+        except FileExistsError:
+            pass
+
+        # the number of shards is fixed once the store has been created
+        shards_path = os.path.join(directory, 'shards')
+        self.created = not os.path.exists(shards_path)
+        if not self.created:
+            with open(shards_path) as f:
+                self.shards = int(f.read())
+        else:
+            with open(shards_path, 'w') as f:
+                f.write(str(shards))
+
+        self.lock = threading.Lock()
+        # shard -> (segment file, index file) opened for appending
+        self.writers = {}
+        # shard -> {key: (offset, length)} for shards that have been read
+        self.indices = {}
+        self.pending = 0
+        self.last_sync = time.time()
+
+    @staticmethod
+    def exists(directory):
+        return os.path.isdir(directory) and any(
+            f.endswith('.idx') for f in os.listdir(directory))
+
+    def _path(self, shard, extension):
+        return os.path.join(self.directory,
+                            '{:04d}.{}'.format(shard, extension))
+
+    def shard_of(self, key):
+        return zlib.crc32(key.encode('utf-8')) % self.shards
+
+    # entries of the index of a shard and the length of its valid part.
+    # Entries are valid up to a partially written one or the first one
+    # pointing past the end of the segment, e.g. after a crash.
+    def _read_index(self, shard):
+        entries = {}
+        valid = 0
+        try:
+            with open(self._path(shard, 'idx'), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return entries, valid
+        try:
+            segment_size = os.path.getsize(self._path(shard, 'seg'))
+        except FileNotFoundError:
+            segment_size = 0
+
+        position = 0
+        while position + INDEX_ENTRY.size <= len(data):
+            offset, length, key_length = INDEX_ENTRY.unpack_from(data,
+                                                                 position)
+            end = position + INDEX_ENTRY.size + key_length
+            if end > len(data) or offset + length > segment_size:
+                break
+            key = data[position + INDEX_ENTRY.size:end].decode('utf-8')
+            entries[key] = (offset, length)
+            position = valid = end
+        return entries, valid
+
+    def _index(self, shard):
+        if shard not in self.indices:
+            self.indices[shard] = self._read_index(shard)[0]
+        return self.indices[shard]
+
+    def _writer(self, shard):
+        if shard not in self.writers:
+            # drop invalid index entries from an interrupted run
+            entries, valid = self._read_index(shard)
+            index = open(self._path(shard, 'idx'), 'ab')
+            index.truncate(valid)
+            segment = open(self._path(shard, 'seg'), 'ab')
+            self.writers[shard] = (segment, index)
+            self.indices.setdefault(shard, entries)
+        return self.writers[shard]
+
+    def put(self, key, payload, shard=None):
+        if shard is None:
+            shard = self.shard_of(key)
+        encoded_key = key.encode('utf-8')
+        compressed = zlib.compress(payload, self.level)
+
+        with self.lock:
+            segment, index = self._writer(shard)
+            offset = segment.tell() + RECORD_HEADER.size + len(encoded_key)
+            segment.write(RECORD_HEADER.pack(len(encoded_key),
+                                             len(compressed)))
+            segment.write(encoded_key)
+            segment.write(compressed)
+            # the index may be flushed any time once its buffer is full, so
+            # the record has to be written first
+            segment.flush()
+            index.write(INDEX_ENTRY.pack(offset, len(compressed),
+                                         len(encoded_key)))
+            index.write(encoded_key)
+            self.indices[shard][key] = (offset, len(compressed))
+
+            self.pending += 1
+            if self.pending >= self.sync_every or \
+                    time.time() - self.last_sync >= self.sync_interval:
+                self._sync()
+
+    def _sync(self):
+        # segments first so that the index never points to missing data
+        # after a crash of the system
+        for segment, _ in self.writers.values():
+            segment.flush()
+            os.fsync(segment.fileno())
+        for _, index in self.writers.values():
+            index.flush()
+            os.fsync(index.fileno())
+        self.pending = 0
+        self.last_sync = time.time()
+
+    def sync(self):
+        with self.lock:
+            self._sync()
+
+    def close(self):
+        with self.lock:
+            self._sync()
+            for segment, index in self.writers.values():
+                segment.close()
+                index.close()
+            self.writers = {}
+
+    def _shards(self, shard):
+        if shard is None:
+            return range(self.shards)
+        return [shard]
+
+    def keys(self, shard=None, prefix=None):
+        for shard in self._shards(shard):
+            with self.lock:
+                keys = [key for key in self._index(shard)
+                        if prefix is None or key.startswith(prefix)]
+            for key in keys:
+                yield key
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self._index(self.shard_of(key))
+
+    def get(self, key, shard=None):
+        if shard is None:
+            shard = self.shard_of(key)
+        with self.lock:
+            offset, length = self._index(shard)[key]
+            if shard in self.writers:
+                self.writers[shard][0].flush()
+        with open(self._path(shard, 'seg'), 'rb') as f:
+            f.seek(offset)
+            return zlib.decompress(f.read(length))
+
+    def _entries(self, shard, prefix, keys):
+        with self.lock:
+            entries = sorted(
+                (offset, length, key)
+                for key, (offset, length) in self._index(shard).items()
+                if (prefix is None or key.startswith(prefix)) and
+                (keys is None or key in keys))
+            if shard in self.writers:
+                self.writers[shard][0].flush()
+        return entries
+
+    # (key, offset, length) of the records in the order they have been
+    # written, optionally only for keys with the given prefix
+    def entries(self, shard=None, prefix=None):
+        return [(key, offset, length)
+                for shard in self._shards(shard)
+                for offset, length, key in self._entries(shard, prefix,
+                                                         None)]
+
+    # iterates (key, payload) in the order the records have been written,
+    # optionally only for keys with the given prefix or from a set of keys
+    def items(self, shard=None, prefix=None, keys=None):
+        for shard in self._shards(shard):
+            entries = self._entries(shard, prefix, keys)
+            if not entries:
+                continue
+            with open(self._path(shard, 'seg'), 'rb') as f:
+                for offset, length, key in entries:
+                    f.seek(offset)
+                    yield key, zlib.decompress(f.read(length))
+
+    # like items() but with the payload as an iterator of chunks which are
+    # decompressed lazily, so that readers of a prefix do not decompress the
+    # rest. The chunks of a record have to be read before the next record.
+    def chunked_items(self, shard=None, prefix=None, keys=None,
+                      chunk_size=4096):
+        for shard in self._shards(shard):
+            entries = self._entries(shard, prefix, keys)
+            if not entries:
+                continue
+            with open(self._path(shard, 'seg'), 'rb') as f:
+                for offset, length, key in entries:
+                    yield key, _chunks(f, offset, length, chunk_size)
+
+
+def _chunks(f, offset, length, chunk_size):
+    decompressor = zlib.decompressobj()
+    end = offset + length
+    while offset < end:
+        f.seek(offset)
+        data = f.read(min(chunk_size, end - offset))
+        if not data:
+            break
+        offset += len(data)
+        chunk = decompressor.decompress(data)
+        if chunk:
+            yield chunk
+    yield decompressor.flush()
@@ -0,0 +1,64 @@
+import hashlib
+
+import segments
+
+PAGES = ['photo', 'user']
+
+
+# Progression snapshots inside a SegmentStore. Keys mirror the former
+# directory layout (<photo_id>/<timestamp>/photo.html) and all records of a
+# photo are kept in the same shard.
+class SnapshotStore(segments.SegmentStore):
+
+    def _shard(self, photo_id):
+        return int(photo_id) % self.shards
+
+    def put_page(self, photo_id, timestamp, page, contents):
+        self.put('{}/{}/{}.html'.format(photo_id, int(timestamp), page),
+                 contents, shard=self._shard(photo_id))
+
+    # marks a page as identical to the last one stored for the photo
+    def put_unchanged(self, photo_id, timestamp, page):
+        self.put('{}/{}/{}.unchanged'.format(photo_id, int(timestamp), page),
+                 b'', shard=self._shard(photo_id))
+
+    # status is either 'ok' or 'error' and finishes the photo
+    def put_status(self, photo_id, status, contents):
+        self.put('{}/{}'.format(photo_id, status), contents,
+                 shard=self._shard(photo_id))
+
+    def photo_ids(self, finished=False):
+        photo_ids = set()
+        for key in self.keys():
+            parts = key.split('/')
+            if not finished or len(parts) == 2:
+                photo_ids.add(int(parts[0]))
+        return photo_ids
+
+    # sorted list of (timestamp, {page: contents}) with None as contents for
+    # pages marked as unchanged. Snapshots without all pages (a failed fetch
+    # after storing the first page) are skipped.
+    def snapshots(self, photo_id):
+        snapshots = {}
+        for key, contents in self.items(shard=self._shard(photo_id),
+                                        prefix='{}/'.format(photo_id)):
+            parts = key.split('/')
+            if len(parts) != 3:
+                continue
+            page, kind = parts[2].split('.')
+            snapshots.setdefault(int(parts[1]), {})[page] = \
+                contents if kind == 'html' else None
+        return sorted((timestamp, pages)
+                      for timestamp, pages in snapshots.items()
+                      if len(pages) == len(PAGES))
+
+    # changes whenever a record of the photo is added or rewritten
+    def fingerprint(self, photo_id):
+        entries = self.entries(shard=self._shard(photo_id),
+                               prefix='{}/'.format(photo_id))
+        digest = hashlib.sha256(repr(entries).encode('utf-8'))
+        return {
+            'size': sum(length for _, _, length in entries),
+            'mtime': 0,
+            'hash': digest.hexdigest(),
+        }
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+
+import argparse
+import datetime
+import html
+import io
+import json
+import os
+import os.path
+import random
+import subprocess
+import tarfile
+
+import pandas as pd
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+import extract
+
+
+# first upload time of the generated photos
+EPOCH = 1488326400
+CATEGORIES = ['Nature', 'Landscapes', 'City and Architecture', 'People',
+              'Street', 'Animals', 'Black and White', 'Travel']
+WORDS = ['light', 'morning', 'river', 'mountain', 'city', 'portrait', 'sky',
+         'forest', 'winter', 'sunset', 'street', 'sea', 'night', 'colors']
+
+
+def _date(timestamp):
+    return datetime.datetime.fromtimestamp(
+        timestamp, datetime.timezone(datetime.timedelta(hours=-5))).isoformat()
+
+
+def _text(rng, words):
+    return ' '.join(rng.choice(WORDS) for _ in range(words))
+
+
+# value of a JSON field of the preloaded data for the parser of its table
+def _json_value(rng, parser):
+    if parser is int:
+        return rng.randint(0, 1000)
+    elif parser is float:
+        return round(rng.uniform(0, 100), 1)
+    elif parser is bool:
+        return rng.random() < 0.2
+    elif parser is len:
+        return [{'id': i} for i in range(rng.randint(0, 5))]
+    elif parser is pd.to_datetime:
+        return _date(EPOCH - rng.randint(0, 10 ** 8))
+    return _text(rng, 2)
+
+
+# State of a generated photo and its author which evolves from snapshot to
+# snapshot like a real progression.
+class Photo(object):
+
+    def __init__(self, photo_id, seed=0):
+        self.photo_id = photo_id
+        self.rng = random.Random(seed * 1000003 + photo_id)
+        rng = self.rng
+        self.uploaded = EPOCH + rng.randint(0, 30 * 86400)
+
+        self.photo = {entry: _json_value(rng, parser)
+                      for entry, _, parser in extract.PHOTO_JSON_PARSE}
+        self.user = {entry: _json_value(rng, parser)
+                     for entry, _, parser in extract.PHOTO_JSON_USER_PARSE}
+        self.photo.update({
+            'rating': 0., 'highest_rating': 0., 'times_viewed': 0,
+            'votes_count': 0, 'favorites_count': 0, 'comments_count': 0,
+            'category': rng.randint(0, 30), 'taken_at': _date(
+                self.uploaded - rng.randint(0, 10 ** 7)),
+        })
+        self.user.update({
+            'sex': rng.randint(0, 2),
+            'followers_count': int(rng.paretovariate(1.2) * 20),
+            'affection': int(rng.paretovariate(1.2) * 100),
+        })
+        self.meta = {
+            'category': rng.choice(CATEGORIES),
+            'latitude': round(rng.uniform(-60, 70), 6),
+            'longitude': round(rng.uniform(-180, 180), 6),
+            'tags': [rng.choice(WORDS) for _ in range(rng.randint(0, 20))],
+            'title': _text(rng, rng.randint(1, 5)),
+            'description': _text(rng, rng.randint(0, 30)),
+            'width': rng.choice([900, 1024, 2048]),
+            'height': rng.choice([600, 768, 1365]),
+        }
+        self.counts = {name: int(rng.paretovariate(1.2) * 10)
+                       for name in ['views', 'following', 'photos',
+                                    'galleries', 'groups', 'marketplace']}
+        self.popularity = rng.paretovariate(1.5)
+
+    # advances the progression, returns whether the user page changed
+    def advance(self):
+        rng = self.rng
+        photo = self.photo
+        views = int(rng.expovariate(1. / (5 * self.popularity)))
+        votes = int(views * rng.uniform(0, 0.3))
+        photo['times_viewed'] += views
+        photo['votes_count'] += votes
+        photo['favorites_count'] += int(votes * rng.uniform(0, 0.3))
+        photo['comments_count'] += int(rng.random() < 0.05)
+        photo['rating'] = round(min(100., photo['rating'] * 0.9 +
+                                    votes * rng.uniform(0.5, 2)), 1)
+        photo['highest_rating'] = max(photo['highest_rating'],
+                                      photo['rating'])
+
+        changed = rng.random() < 0.3
+        if changed:
+            self.user['followers_count'] += rng.randint(0, 3)
+            self.counts['views'] += views
+        return changed
+
+    def photo_page(self, filler=200):
+        meta = self.meta
+        properties = [
+            ('five_hundred_pixels:category', meta['category']),
+            ('five_hundred_pixels:highest_rating',
+             self.photo['highest_rating']),
+            ('five_hundred_pixels:location:latitude', meta['latitude']),
+            ('five_hundred_pixels:location:longitude', meta['longitude']),
+        ] + [('five_hundred_pixels:tags', tag) for tag in meta['tags']] + [
+            ('five_hundred_pixels:uploaded', _date(self.uploaded)),
+            ('og:title', meta['title']),
+            ('og:description', meta['description']),
+            ('og:image:width', meta['width']),
+            ('og:image:height', meta['height']),
+        ]
+        data = dict(self.photo, user=self.user)
+        return (
+            '<!DOCTYPE html>\n<html><head><meta charset="utf-8"/>\n{}\n'
+            '</head><body>\n{}\n<script>window.PxPreloadedData = {};'
+            '</script>\n</body></html>\n'.format(
+                '\n'.join('<meta property="{}" content="{}"/>'.format(
+                    name, html.escape(str(value), quote=True))
+                    for name, value in properties),
+                ''.join('<div class="item"><p>{}</p></div>'.format(
+                    _text(self.rng, 8)) for _ in range(filler)),
+                json.dumps({'photo': data}))).encode('utf-8')
+
+    def user_page(self, filler=200):
+        counts = dict(self.counts,
+                      followers=self.user['followers_count'])
+        items = ''.join(
+            '<li class="{0}"><a><span class="count">{1:,}</span></a></li>'
+            .format(name, counts[name])
+            for name in ['photos', 'galleries', 'groups', 'marketplace'])
+        return (
+            '<!DOCTYPE html>\n<html><head><title>user</title></head><body>\n'
+            '{}\n<ul><li class="views"><span>{:,}</span></li>'
+            '<li class="followers"><span>{:,}</span></li>'
+            '<li class="following"><span>{:,}</span></li>{}</ul>\n'
+            '</body></html>\n'.format(
+                ''.join('<div>{}</div>'.format(_text(self.rng, 8))
+                        for _ in range(filler)),
+                counts['views'], counts['followers'], counts['following'],
+                items)).encode('utf-8')
+
+
+def _compress(data):
+    if brotli is not None:
+        return brotli.compress(data, quality=5)
+    # compress with the brotli binary if the module is not installed
+    return subprocess.run(['brotli', '-c', '-q', '5'], input=data,
+                          stdout=subprocess.PIPE, check=True).stdout
+
+
+# Writes the progression of a photo with the given number of snapshots as a
+# tar.br archive in the layout of progressions.py. Unchanged user pages are
+# stored as markers like for a 304 response.
+def write_archive(out_dir, photo_id, snapshots=288, interval=600, seed=0,
+                  filler=200):
+    photo = Photo(photo_id, seed)
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w') as tar:
+
+        def add(name, contents):
+            info = tarfile.TarInfo('progressions/{}/{}'.format(photo_id,
+                                                               name))
+            info.size = len(contents)
+            info.mtime = timestamp
+            tar.addfile(info, io.BytesIO(contents))
+
+        timestamp = photo.uploaded
+        for snapshot in range(snapshots):
+            timestamp += interval + photo.rng.randint(0, interval // 10)
+            changed = photo.advance()
+            add('{}/photo.html'.format(timestamp), photo.photo_page(filler))
+            if changed or snapshot == 0:
+                add('{}/user.html'.format(timestamp), photo.user_page(filler))
+            else:
+                add('{}/user.unchanged'.format(timestamp), b'')
+
+    path = os.path.join(out_dir, '{}-synthetic.tar.br'.format(photo_id))
+    with open(path, 'wb') as f:
+        f.write(_compress(buffer.getvalue()))
+    return path
+
+
+# archives of photos with consecutive IDs starting at first_id
+def generate(out_dir, photos=10, snapshots=288, interval=600, seed=0,
+             filler=200, first_id=1):
+    try:
+        os.makedirs(out_dir)
+    except FileExistsError:
+        pass
+    return [write_archive(out_dir, photo_id, snapshots, interval, seed,
+                          filler)
+            for photo_id in range(first_id, first_id + photos)]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Generates synthetic progression archives')
+    parser.add_argument('out', metavar='DIRECTORY')
+    parser.add_argument('-n', '--photos', type=int, default=10)
+    parser.add_argument('-s', '--snapshots', type=int, default=288)
+    parser.add_argument('-i', '--interval', type=int, default=600,
+                        help='seconds between snapshots')
+    parser.add_argument('--filler', type=int, default=200,
+                        help='filler elements per page, controls page size')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    archives = generate(args.out, args.photos, args.snapshots, args.interval,
+                        args.seed, args.filler)
+    print('{} archives written to {}'.format(len(archives), args.out))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+import hashlib
+import os
+import os.path
+
+import pyarrow.feather as feather
+
+
+# Fingerprint of a set of input files by their paths, sizes and modification
+# times, together with the version of the code deriving a table from them and
+# further parameters of it.
+def fingerprint(files, version, *parameters):
+    digest = hashlib.sha256(repr((version, parameters)).encode('utf-8'))
+    for path in sorted(files):
+        stat = os.stat(path)
+        digest.update('{}\0{}\0{}\n'.format(path, stat.st_size,
+                                            stat.st_mtime_ns).encode('utf-8'))
+    return digest.hexdigest()[:32]
+
+
+# Cache of derived frames in a directory, one Feather file per table and
+# fingerprint. Tables which have not been used for the longest time are
+# removed once the files exceed max_bytes. The directory is only created
+# when the first table is stored.
+class TableCache(object):
+
+    def __init__(self, directory, max_bytes=2 << 30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def _path(self, name, key):
+        return os.path.join(self.directory, '{}-{}.feather'.format(name, key))
+
+    def get(self, name, key):
+        path = self._path(name, key)
+        try:
+            frame = feather.read_feather(path)
+        except FileNotFoundError:
+            return None
+        # the modification time orders the tables by their last use
+        os.utime(path)
+        return frame
+
+    def put(self, name, key, frame):
+        try:
+            os.makedirs(self.directory)
+        except FileExistsError:
+            pass
+        path = self._path(name, key)
+        temp_path = '{}.{}.tmp'.format(path, os.getpid())
+        feather.write_feather(frame, temp_path, compression='lz4')
+        os.replace(temp_path, path)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.feather'):
+                stat = os.stat(os.path.join(self.directory, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.directory, name))
+            total -= size
+
+    # the table derived from files by compute(), which is only called if the
+    # files, the version or the parameters changed
+    def cached(self, name, files, version, compute, *parameters):
+        key = fingerprint(files, version, *parameters)
+        frame = self.get(name, key)
+        if frame is None:
+            frame = compute()
+            self.put(name, key, frame)
+        return frame